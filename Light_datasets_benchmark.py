@@ -0,0 +1,342 @@
+## ETL BENCHMARK ON SYNTHETIC DATASETS
+
+
+# GET STARTED
+
+import pandas as pd
+import numpy as np
+
+import os
+import sys
+import json
+import time
+import shutil
+import filecmp
+import argparse
+import subprocess
+import multiprocessing
+from datetime import datetime
+
+from Light_datasets_creation import (NODES, RAW_FILE, LIGHT_FILE, TEMP_FILE, CACHE_DIR, PARTIALS_DIR,
+                                     QUALITY_DIR, ETL_WORKERS, nuclear_free_regions, node_closure, file_hash)
+
+# SYNTHETIC DATASETS
+# Seeded eco2mix, df_light and temperature files with the real column names, written one calendar year at a time.
+# The 2013-2022 calendar holds 2.1M half-hourly rows for the 12 regions: smaller sizes take its last years
+# (page 3 needs 2022), larger sizes go through it again, so each (region, slot) then appears several times
+# (the temperature file covers the calendar once).
+# Quirks of the real export: 'ND' and '-' in "Eolien (MW)", no nuclear values in the nuclear-free regions
+# until 2020 (0 from 2021), no pumping in some regions, TCO/TCH rates and battery columns only from 2020.
+SYNTHETIC_VERSION = 1
+YEARS = range(2013, 2023)
+# (INSEE code, name in eco2mix and temperature files, name in df_light)
+SYNTHETIC_REGIONS = [(84, "Auvergne-Rhône-Alpes", "Auvergne-Rhone-Alpes"),
+                     (27, "Bourgogne-Franche-Comté", "Bourgogne-Franche-Comte"),
+                     (53, "Bretagne", "Bretagne"), (24, "Centre-Val de Loire", "Centre-Val de Loire"),
+                     (44, "Grand Est", "Grand Est"), (32, "Hauts-de-France", "Hauts-de-France"),
+                     (11, "Île-de-France", "Ile-de-France"), (28, "Normandie", "Normandie"),
+                     (75, "Nouvelle-Aquitaine", "Nouvelle-Aquitaine"), (76, "Occitanie", "Occitanie"),
+                     (52, "Pays de la Loire", "Pays de la Loire"),
+                     (93, "Provence-Alpes-Côte d'Azur", "Provence-Alpes-Cote d'Azur")]
+NO_PUMPING_REGIONS = ["Bretagne", "Centre-Val de Loire", "Hauts-de-France", "Ile-de-France", "Normandie",
+                      "Pays de la Loire"]
+SECTORS_FR = ['Thermique', 'Nucléaire', 'Eolien', 'Solaire', 'Hydraulique', 'Bioénergies']
+RATE_COLUMNS = [f"{rate} {sector} (%)" for sector in SECTORS_FR for rate in ['TCO', 'TCH']]
+RAW_COLUMNS = (['Code INSEE région', 'Région', 'Nature', 'Date', 'Heure', 'Date - Heure', 'Consommation (MW)']
+               + [f"{sector} (MW)" for sector in SECTORS_FR[:5]]
+               + ['Pompage (MW)', 'Bioénergies (MW)', 'Ech. physiques (MW)', 'Stockage batterie',
+                  'Déstockage batterie', 'Eolien terrestre', 'Eolien offshore'] + RATE_COLUMNS + ['Column 30'])
+
+# Daily temperatures of one year, shape (regions, days)
+def synthetic_temperatures(rng, days):
+    doy = days.dayofyear.to_numpy()
+    tavg = 12 - 8 * np.cos(2 * np.pi * (doy - 15) / 365.25) + rng.normal(0, 3, (len(SYNTHETIC_REGIONS), len(days)))
+    spread = rng.uniform(2, 6, tavg.shape)
+    return (tavg - spread).round(2), (tavg + spread).round(2), tavg.round(2)
+
+def synthetic_year(rng, year, base):
+    slots = pd.date_range(f"{year}-01-01", f"{year}-12-31 23:30", freq='30min')
+    days = pd.date_range(f"{year}-01-01", f"{year}-12-31")
+    n_regions, n = len(SYNTHETIC_REGIONS), len(slots)
+    tmin, tmax, tavg = synthetic_temperatures(rng, days)
+    codes, raw_names, light_names = (np.repeat(np.array(column), n) for column in zip(*SYNTHETIC_REGIONS))
+    hour = np.tile(slots.hour.to_numpy() + slots.minute.to_numpy() / 60, n_regions)
+    heating = np.maximum(18 - np.repeat(tavg, 48, axis=1), 0).ravel()
+    daily = 1 + 0.15 * np.sin(2 * np.pi * (hour - 7) / 24)
+    mw = lambda scale: rng.uniform(0, scale, n_regions * n).round()
+    consumption = (np.repeat(base, n) * (1 + 0.03 * heating) * daily * rng.normal(1, 0.03, n_regions * n)).round()
+    nuclear_free = np.isin(light_names, nuclear_free_regions)
+    nuclear = np.where(nuclear_free, np.nan if year < 2021 else 0.0, mw(10000))
+    wind = mw(1500).astype('int64').astype(str).astype(object)
+    quirks = rng.random(n_regions * n)
+    wind[quirks < 0.005] = 'ND'
+    wind[(quirks >= 0.005) & (quirks < 0.01)] = '-'
+    solar = (np.maximum(np.sin(np.pi * (hour - 6) / 14), 0) * mw(1200)).round()
+    thermal, hydro, bio = mw(2000), mw(3000), mw(300)
+    pumping = np.where(np.isin(light_names, NO_PUMPING_REGIONS), np.nan, -mw(500))
+    dates, hours = np.tile(slots.strftime('%Y-%m-%d'), n_regions), np.tile(slots.strftime('%H:%M'), n_regions)
+    raw = pd.DataFrame({'Code INSEE région': codes, 'Région': raw_names, 'Nature': 'Données définitives',
+                        'Date': dates, 'Heure': hours,
+                        'Date - Heure': np.tile(slots.strftime('%Y-%m-%dT%H:%M:%S+01:00'), n_regions),
+                        'Consommation (MW)': consumption, 'Thermique (MW)': thermal, 'Nucléaire (MW)': nuclear,
+                        'Eolien (MW)': wind, 'Solaire (MW)': solar, 'Hydraulique (MW)': hydro,
+                        'Pompage (MW)': pumping, 'Bioénergies (MW)': bio,
+                        'Ech. physiques (MW)': consumption - np.nansum([thermal, nuclear, solar, hydro, bio], axis=0)},
+                       columns=RAW_COLUMNS)
+    if year >= 2020:
+        raw[['Stockage batterie', 'Déstockage batterie']] = 0.0
+        raw[RATE_COLUMNS] = rng.uniform(0, 100, (n_regions * n, len(RATE_COLUMNS))).round(2)
+        raw.loc[nuclear_free, ['TCO Nucléaire (%)', 'TCH Nucléaire (%)']] = np.nan
+    light = pd.DataFrame({'Region': light_names, 'Date': dates, 'Hour': hours, 'Year': year,
+                          'Consumption': consumption, 'Nuclear': np.nan_to_num(nuclear),
+                          'Hydro': hydro, 'Wind': pd.to_numeric(wind, errors='coerce'), 'Solar': solar,
+                          'Bioenergy': bio, 'Thermal': thermal})
+    temperature = pd.DataFrame({'ID': [f"{day}-{code}" for code, *_ in SYNTHETIC_REGIONS
+                                       for day in days.strftime('%Y-%m-%d')],
+                                'Date': np.tile(days.strftime('%Y-%m-%d'), n_regions),
+                                'Code INSEE région': np.repeat(codes[::n], len(days)),
+                                'Région': np.repeat(raw_names[::n], len(days)),
+                                'TMin (°C)': tmin.ravel(), 'TMax (°C)': tmax.ravel(), 'TMoy (°C)': tavg.ravel()})
+    # one row per region for each slot, as in the export, so that a truncated year still has every region
+    order = np.arange(n_regions * n).reshape(n_regions, n).T.ravel()
+    return raw.iloc[order], light.iloc[order], temperature
+
+# Writes about `rows` rows in each file of `directory`, unless it already holds the same (rows, seed) data
+def datasets_ready(directory, rows, seed):
+    try:
+        with open(os.path.join(directory, '_synthetic.json')) as f:
+            return json.load(f) == {'rows': rows, 'seed': seed, 'version': SYNTHETIC_VERSION}
+    except FileNotFoundError:
+        return False
+
+def generate_datasets(directory, rows, seed=42):
+    if datasets_ready(directory, rows, seed):
+        return
+    print(f"Generating {rows} synthetic rows in {directory}")
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    base = rng.uniform(2000, 8000, len(SYNTHETIC_REGIONS))
+    paths = [os.path.join(directory, name) for name in [RAW_FILE, LIGHT_FILE, TEMP_FILE]]
+    years = YEARS[max(0, len(YEARS) - int(np.ceil(rows / (len(SYNTHETIC_REGIONS) * 17520)))):]
+    written, cycle = 0, 0
+    while written < rows:
+        for year in years:
+            raw, light, temperature = synthetic_year(rng, year, base)
+            mode = 'a' if written else 'w'
+            raw.iloc[:rows - written].to_csv(paths[0], sep=';', index=False, header=not written, mode=mode,
+                                             float_format='%g')
+            light.iloc[:rows - written].to_csv(paths[1], sep=',', index=False, header=not written, mode=mode,
+                                               float_format='%g')
+            if cycle == 0:
+                temperature.to_csv(paths[2], sep=';', index=False, header=not written, mode=mode)
+            written += min(len(raw), rows - written)
+            if written >= rows:
+                break
+        cycle += 1
+    with open(os.path.join(directory, '_synthetic.json'), 'w') as f:
+        json.dump({'rows': rows, 'seed': seed, 'version': SYNTHETIC_VERSION}, f)
+
+# BENCHMARK
+# Each ETL node runs in its own process, in dependency order, on the synthetic files of one size.
+# Wall time and peak RSS (of the largest process, pool workers included, from os.wait4) are appended
+# to RESULTS_FILE with the commit and the hash of the ETL script, so runs can be compared over time.
+# A child process starts from the peak RSS of its parent on Linux, so the datasets are generated in a
+# separate process and the floor is the memory of this script (pandas and pyarrow imported).
+BENCH_DIR = 'light_benchmark'
+RESULTS_FILE = os.path.join(BENCH_DIR, 'results.csv')
+ETL_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Light_datasets_creation.py')
+SIZES = {'2M': 2_000_000, '20M': 20_000_000, '100M': 100_000_000}
+BENCH_TOLERANCE = 0.2 # slowdown or memory growth flagged against the previous run
+
+def parse_size(size):
+    if size in SIZES:
+        return SIZES[size]
+    multiplier = {'k': 1_000, 'M': 1_000_000}.get(size[-1], 1)
+    return int(float(size.rstrip('kM')) * multiplier)
+
+# Nodes that only read the synthetic files (directly or through their dependencies): the others, like the
+# images of the app, have no sources in the benchmark directories
+def synthetic_nodes():
+    names = []
+    for name, node in NODES.items(): # dependencies are declared before the nodes using them
+        if set(node['sources']) <= {RAW_FILE, LIGHT_FILE, TEMP_FILE} and set(node['deps']) <= set(names):
+            names.append(name)
+    return names
+
+# Nodes of the closure of `targets`, dependencies first
+def stage_order(targets):
+    names, order = node_closure(targets), []
+    def visit(name):
+        if name not in order:
+            for dep in NODES[name]['deps']:
+                visit(dep)
+            order.append(name)
+    for name in NODES:
+        if name in names:
+            visit(name)
+    return order
+
+# Removes what a previous benchmark run left in `directory`, keeping the synthetic sources
+def clear_outputs(directory):
+    for name in [CACHE_DIR, PARTIALS_DIR, QUALITY_DIR]:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    for node in NODES.values():
+        for path in node['outputs']:
+            if os.path.isfile(os.path.join(directory, path)):
+                os.remove(os.path.join(directory, path))
+
+def run_stage(stage, directory, workers, log):
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, ETL_SCRIPT, stage, '--workers', str(workers)],
+                               cwd=directory, stdout=log, stderr=subprocess.STDOUT)
+    if hasattr(os, 'wait4'):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        peak_rss = usage.ru_maxrss / 1024 # kB on Linux
+    else: # no per-process rusage on Windows
+        process.wait()
+        peak_rss = np.nan
+    if process.returncode:
+        raise RuntimeError(f"stage {stage} failed, see {log.name}")
+    return time.perf_counter() - start, peak_rss
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(ETL_SCRIPT),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def run_benchmark(size, seed=42, workers=ETL_WORKERS, targets=None):
+    rows = parse_size(size)
+    directory = os.path.join(BENCH_DIR, f"data_{size}")
+    results = []
+    if not datasets_ready(directory, rows, seed):
+        start = time.perf_counter()
+        generator = multiprocessing.get_context('spawn').Process(target=generate_datasets, args=(directory, rows, seed))
+        generator.start()
+        generator.join()
+        if generator.exitcode:
+            raise RuntimeError(f"generation of {size} rows failed")
+        results.append(('generate', time.perf_counter() - start, np.nan))
+    clear_outputs(directory)
+    with open(os.path.join(directory, 'benchmark.log'), 'w') as log:
+        for stage in stage_order(targets or synthetic_nodes()):
+            seconds, peak_rss = run_stage(stage, directory, workers, log)
+            print(f"{size} {stage}: {seconds:.1f} s, peak RSS {peak_rss:.0f} MB")
+            results.append((stage, seconds, peak_rss))
+    run = pd.DataFrame(results, columns=['Stage', 'Seconds', 'Peak RSS (MB)'])
+    run.insert(0, 'Run', datetime.now().isoformat(timespec='seconds'))
+    run.insert(1, 'Commit', current_commit())
+    run.insert(2, 'ETL hash', file_hash(ETL_SCRIPT)[:12])
+    run.insert(3, 'Rows', rows)
+    run.insert(4, 'Seed', seed)
+    run.insert(5, 'Workers', workers)
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    run.round(3).to_csv(RESULTS_FILE, sep=',', index=False, mode='a', header=not os.path.exists(RESULTS_FILE))
+    return run
+
+# Latest run of each (Rows, Workers) against the previous one, or against the runs of a baseline commit
+def compare_runs(results, baseline=None, tolerance=BENCH_TOLERANCE):
+    comparisons = []
+    for (rows, workers), runs in results.groupby(['Rows', 'Workers']):
+        latest = runs[runs['Run'] == runs['Run'].max()]
+        previous = runs[runs['Commit'] == baseline] if baseline else runs[runs['Run'] < runs['Run'].max()]
+        if previous.empty:
+            continue
+        previous = previous[previous['Run'] == previous['Run'].max()]
+        merged = latest.merge(previous, on=['Rows', 'Workers', 'Stage'], suffixes=('', ' before'))
+        comparisons.append(merged)
+    if not comparisons:
+        return pd.DataFrame()
+    report = pd.concat(comparisons, ignore_index=True)
+    report['Time ratio'] = report['Seconds'] / report['Seconds before']
+    report['RSS ratio'] = report['Peak RSS (MB)'] / report['Peak RSS (MB) before']
+    report['Regression'] = (report['Time ratio'] > 1 + tolerance) | (report['RSS ratio'] > 1 + tolerance)
+    return report[['Rows', 'Workers', 'Stage', 'Commit before', 'Commit', 'Seconds before', 'Seconds',
+                   'Time ratio', 'Peak RSS (MB) before', 'Peak RSS (MB)', 'RSS ratio', 'Regression']].round(2)
+
+# INCREMENTAL CHECK
+# The page 3 outputs of an incremental run must match a full rebuild byte for byte. Two exports of the same
+# synthetic data are folded in one after the other: an export cut in the middle of a month and then the
+# complete one, or the complete export and then a copy with an older month revised. The ETL then runs with
+# --full on the second export in another directory, and the p3g1-p3g5 files of both runs are compared.
+INCREMENTAL_TARGETS = ['p3g1', 'p3g2', 'p3g3', 'p3g4', 'p3g5']
+INCREMENTAL_OUTPUTS = [path for name in INCREMENTAL_TARGETS for path in NODES[name]['outputs']]
+
+# Writes the raw and light frames (read as text, so the values are written back unchanged) with the
+# temperature file of `source`
+def write_sources(directory, raw, light, source):
+    os.makedirs(directory, exist_ok=True)
+    raw.to_csv(os.path.join(directory, RAW_FILE), sep=';', index=False)
+    light.to_csv(os.path.join(directory, LIGHT_FILE), sep=',', index=False)
+    shutil.copyfile(os.path.join(source, TEMP_FILE), os.path.join(directory, TEMP_FILE))
+
+def run_etl(directory, args, workers, log):
+    subprocess.run([sys.executable, ETL_SCRIPT, *INCREMENTAL_TARGETS, '--workers', str(workers), *args],
+                   cwd=directory, stdout=log, stderr=subprocess.STDOUT, check=True)
+
+# Consumption of the month `period` ('YYYY-MM') raised by 1 %
+def revise_month(df, column, period):
+    df = df.copy()
+    rows = df['Date'].str.startswith(period) & (df[column] != '')
+    df.loc[rows, column] = (df.loc[rows, column].astype(float) * 1.01).round().map('{:g}'.format)
+    return df
+
+def check_incremental(size, seed=42, workers=ETL_WORKERS):
+    rows = parse_size(size)
+    source = os.path.join(BENCH_DIR, f"data_{size}")
+    generate_datasets(source, rows, seed)
+    raw = pd.read_csv(os.path.join(source, RAW_FILE), sep=';', dtype=str, keep_default_na=False)
+    light = pd.read_csv(os.path.join(source, LIGHT_FILE), sep=',', dtype=str, keep_default_na=False)
+    cut = (pd.Timestamp(raw['Date'].max()) - pd.DateOffset(months=1)).strftime('%Y-%m-15')
+    first_month = raw['Date'].min()[:7]
+    revised = (revise_month(raw, 'Consommation (MW)', first_month), revise_month(light, 'Consumption', first_month))
+    scenarios = [(f"export cut on {cut}, then complete", (raw[raw['Date'] < cut], light[light['Date'] < cut]), (raw, light)),
+                 (f"{first_month} revised", (raw, light), revised)]
+    incremental, full = (os.path.join(BENCH_DIR, f"data_{size}_{kind}") for kind in ['incremental', 'full'])
+    mismatches = []
+    with open(os.path.join(source, 'incremental.log'), 'w') as log:
+        for name, before, after in scenarios:
+            for directory in [incremental, full]:
+                shutil.rmtree(directory, ignore_errors=True)
+            write_sources(incremental, *before, source)
+            run_etl(incremental, [], workers, log)
+            write_sources(incremental, *after, source)
+            run_etl(incremental, [], workers, log)
+            write_sources(full, *after, source)
+            run_etl(full, ['--full'], workers, log)
+            differ = [path for path in INCREMENTAL_OUTPUTS
+                      if not filecmp.cmp(os.path.join(incremental, path), os.path.join(full, path), shallow=False)]
+            print(f"{size} {name}: " + (f"differs from a full rebuild in {', '.join(differ)}" if differ
+                                        else "identical to a full rebuild"))
+            mismatches += differ
+    return mismatches
+
+def parse_options(args=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the ETL stages on synthetic eco2mix datasets.")
+    parser.add_argument('sizes', nargs='*', default=['2M'],
+                        help=f"rows per dataset, e.g. 500k or {', '.join(SIZES)} (default: 2M)")
+    parser.add_argument('--seed', type=int, default=42, help="seed of the synthetic datasets")
+    parser.add_argument('--workers', type=int, default=ETL_WORKERS, help="processes used by the ETL stages")
+    parser.add_argument('--stages', nargs='+', choices=synthetic_nodes(), help="nodes to benchmark, with their dependencies")
+    parser.add_argument('--baseline', help="commit to compare with (default: the previous run)")
+    parser.add_argument('--tolerance', type=float, default=BENCH_TOLERANCE,
+                        help="time or memory growth reported as a regression")
+    parser.add_argument('--compare-only', action='store_true', help="only compare the stored results")
+    parser.add_argument('--check-incremental', action='store_true',
+                        help="check that incremental page 3 partials match a full rebuild")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    options = parse_options()
+    if options.check_incremental:
+        failed = [path for size in options.sizes for path in check_incremental(size, options.seed, options.workers)]
+        sys.exit(1 if failed else 0)
+    if not options.compare_only:
+        for size in options.sizes:
+            run_benchmark(size, options.seed, options.workers, options.stages)
+    if os.path.exists(RESULTS_FILE):
+        report = compare_runs(pd.read_csv(RESULTS_FILE, sep=',', dtype={'Commit': str}), options.baseline, options.tolerance)
+        print(report.to_string(index=False) if len(report) else "No earlier run to compare with")
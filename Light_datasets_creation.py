@@ -8,128 +8,1088 @@ import numpy as np
 # import matplotlib.pyplot as plt
 # import seaborn as sns
 # from plotly.subplots import make_subplots
-# import plotly.express as px
+import plotly.express as px
+import plotly.io as pio
 
 
-# Check working directory where files will be downloaded
 import os
-print(os.getcwd())
+import io
+import functools
+import hashlib
+import multiprocessing
+import json
+import shutil
+import time
+from collections import deque
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from urllib.parse import unquote
+import warnings
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from PIL import Image, features
+
+# SCHEMA
+# Compact dtypes shared by the energy frames: categorical labels, small integers for Month / Year
+# and float32 for the MW columns (sums and means are still computed in float64).
+# Categories are in alphabetical order, so grouped outputs keep the same row order as with strings.
+REGIONS = ["Auvergne-Rhone-Alpes", "Bourgogne-Franche-Comte", "Bretagne", "Centre-Val de Loire",
+           "Grand Est", "Hauts-de-France", "Ile-de-France", "Normandie", "Nouvelle-Aquitaine",
+           "Occitanie", "Pays de la Loire", "Provence-Alpes-Cote d'Azur"]
+SEASONS = ['Autumn', 'Spring', 'Summer', 'Winter']
+flows = ['ConsumptionMWh', 'ProductionMWh']
+region_dtype = pd.CategoricalDtype(REGIONS)
+season_dtype = pd.CategoricalDtype(SEASONS)
+flow_dtype = pd.CategoricalDtype(flows)
+SCHEMA = {'Code INSEE région': 'int8', 'Région': 'category', 'Nature': 'category',
+          'Date': 'datetime64[ns]', 'Heure': 'category',
+          'Region': region_dtype, 'Season': season_dtype, 'Flow': flow_dtype,
+          'Month': 'int8', 'Year': 'int16'}
+
+# Season code of each month (index 0 unused): Winter for 12, 1, 2, Spring for 3, 4, 5, etc.
+MONTH_SEASON_CODES = np.array([-1, 3, 3, 1, 1, 1, 2, 2, 2, 0, 0, 0, 3], dtype='int8')
 
-# DATASETS AND TRANSFORMATION 
-dfraw = pd.read_csv('eco2mix-regional-cons-def.csv', sep = ';') # raw dataset  
-dfl = pd.read_csv("df_light.csv", sep = ',') # df_light for other plots
-temp = pd.read_csv('temperature-quotidienne-regionale.csv', sep = ';')
-
-dfraw2 = dfraw.copy()
-dfraw2["Eolien (MW)"] = dfraw2["Eolien (MW)"].replace('ND', np.nan)
-dfraw2["Eolien (MW)"] = dfraw2["Eolien (MW)"].replace('-', np.nan)
-dfraw2["Eolien (MW)"] = dfraw2["Eolien (MW)"].astype(float)
-dfraw2["Production"] = dfraw2["Thermique (MW)"] + dfraw2["Nucléaire (MW)"] + dfraw2["Eolien (MW)"] + dfraw2["Solaire (MW)"] + dfraw2["Hydraulique (MW)"]
-dfraw2['Consumption_MWh'] = dfraw2['Consommation (MW)'] * 0.5
-dfraw2['Production_MWh'] = dfraw2['Production'] * 0.5
-dfraw2['Date'] = pd.to_datetime(dfraw2['Date'])
-dfraw2['Month'] = dfraw2['Date'].dt.month
 def month_to_season(month):
-    if month in [3, 4, 5]:
-        return "Spring"
-    elif month in [6, 7, 8]:
-        return "Summer"
-    elif month in [9, 10, 11]:
-        return "Autumn"
-    else:  # For months 12, 1, 2
-        return "Winter"
-dfraw2['Season'] = dfraw2['Month'].apply(month_to_season)
-
-dfl['Date'] = pd.to_datetime(dfl['Date'])
-dfl['Month'] = dfl['Date'].dt.month
-dfl['ConsumptionMWh'] = dfl['Consumption'] * 0.5
+    return pd.Categorical.from_codes(MONTH_SEASON_CODES[np.asarray(month)], dtype=season_dtype)
+
+def compact(df):
+    dtypes = {col: dtype for col, dtype in SCHEMA.items() if col in df.columns}
+    dtypes.update({col: 'float32' for col in df.select_dtypes('float64').columns})
+    return df.astype(dtypes)
+
+# Memory used by each column of a frame, before and after compaction
+def memory_report(before, after):
+    report = pd.DataFrame({'Before (MB)': before.memory_usage(deep=True, index=False) / 1e6,
+                           'After (MB)': after.memory_usage(deep=True, index=False) / 1e6})
+    report.loc['Total'] = report.sum()
+    report['Ratio'] = (report['After (MB)'] / report['Before (MB)']).map('{:.0%}'.format)
+    return report.round(2)
+
+# DATASETS AND TRANSFORMATION 
+# The raw dataset (2.1M rows, 32 columns) is streamed in chunks: only the columns we need are parsed,
+# with explicit dtypes, and 'ND' / '-' are mapped to NaN while parsing ("Eolien (MW)" is float from the start)
+RAW_FILE = 'eco2mix-regional-cons-def.csv'
+RAW_MW_COLS = ['Consommation (MW)', 'Thermique (MW)', 'Nucléaire (MW)', 'Eolien (MW)', 'Solaire (MW)', 'Hydraulique (MW)']
+RAW_USECOLS = ['Code INSEE région', 'Région', 'Date', 'Heure'] + RAW_MW_COLS
+RAW_DTYPES = {'Code INSEE région': 'int8', 'Région': 'category', 'Date': str, 'Heure': 'category', **{col: 'float32' for col in RAW_MW_COLS}}
+RAW_NA_VALUES = ['ND', '-']
+RAW_CHUNKSIZE = 250000 # set to None to read the whole file at once
+
+def read_raw(path=RAW_FILE, chunksize=RAW_CHUNKSIZE):
+    reader = pd.read_csv(path, sep = ';', usecols=RAW_USECOLS, dtype=RAW_DTYPES,
+                         na_values=RAW_NA_VALUES, chunksize=chunksize)
+    return reader if chunksize else [reader] # always iterate over chunks
+
+LIGHT_FILE = "df_light.csv"
+TEMP_FILE = 'temperature-quotidienne-regionale.csv'
+
+def read_light(path=LIGHT_FILE, chunksize=RAW_CHUNKSIZE):
+    reader = pd.read_csv(path, sep = ',', chunksize=chunksize)
+    return reader if chunksize else [reader]
+
+# Memory breakdown of the first rows of the raw dataset, as the original script loaded it
+# (object strings, float64) and with the compact schema
+def raw_memory_report(path=RAW_FILE, nrows=RAW_CHUNKSIZE):
+    before = pd.read_csv(path, sep = ';', nrows=nrows)
+    after = compact(pd.read_csv(path, sep = ';', nrows=nrows, na_values=RAW_NA_VALUES))
+    print(f"Memory of the first {len(before)} rows of {path}:")
+    print(memory_report(before, after).to_string())
+
+# Same derivations as before, applied in place on each chunk (no more dfraw.copy())
+def clean_raw(dfraw2):
+    dfraw2["Production"] = dfraw2["Thermique (MW)"] + dfraw2["Nucléaire (MW)"] + dfraw2["Eolien (MW)"] + dfraw2["Solaire (MW)"] + dfraw2["Hydraulique (MW)"]
+    dfraw2['Consumption_MWh'] = dfraw2['Consommation (MW)'] * 0.5
+    dfraw2['Production_MWh'] = dfraw2['Production'] * 0.5
+    dfraw2['Date'] = pd.to_datetime(dfraw2['Date'])
+    dfraw2['Year'] = dfraw2['Date'].dt.year
+    dfraw2['Month'] = dfraw2['Date'].dt.month
+    dfraw2['Season'] = month_to_season(dfraw2['Month'])
+    return compact(dfraw2)
+
 nuclear_free_regions = ["Bourgogne-Franche-Comte", "Bretagne","Pays de la Loire", "Provence-Alpes-Cote d'Azur", "Ile-de-France"]
-dfl['NuclearNan'] = dfl['Nuclear']  # Initialize column with existing values
-dfl.loc[dfl['Region'].isin(nuclear_free_regions) & (dfl['Nuclear'] == 0), 'NuclearNan'] = np.nan
-dfl["ProductionMWh"] = 0.5 * dfl[
-    ["NuclearNan", "Hydro", "Wind", "Solar", "Bioenergy", "Thermal"]
-    ].sum(axis=1, min_count=1)
 
+def clean_light(dfl):
+    dfl['Date'] = pd.to_datetime(dfl['Date'])
+    dfl['Month'] = dfl['Date'].dt.month
+    dfl['ConsumptionMWh'] = dfl['Consumption'] * 0.5
+    dfl['NuclearNan'] = dfl['Nuclear']  # Initialize column with existing values
+    dfl.loc[dfl['Region'].isin(nuclear_free_regions) & (dfl['Nuclear'] == 0), 'NuclearNan'] = np.nan
+    dfl["ProductionMWh"] = 0.5 * dfl[
+        ["NuclearNan", "Hydro", "Wind", "Solar", "Bioenergy", "Thermal"]
+        ].sum(axis=1, min_count=1)
+    return compact(dfl)
+
+# CACHE OF THE CLEANED FRAMES
+# dfraw2 and dfl are written once as Parquet files partitioned by Year/Region.
+# Each entry keeps the hash of its source file and is rebuilt only when the source changes
+# (or when CACHE_VERSION is bumped after a change in clean_raw / clean_light).
+CACHE_DIR = 'light_cache'
+CACHE_VERSION = 3
+
+# Memoized on the file size and modification time, so a file is hashed once per run
+def file_hash(path):
+    stat = os.stat(path)
+    return hash_content(path, stat.st_size, stat.st_mtime_ns)
+
+@functools.lru_cache(maxsize=None)
+def hash_content(path, size, mtime):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def build_cache(name, source, read, clean, partition_cols, workers=None):
+    root = os.path.join(CACHE_DIR, name)
+    stamp_file = os.path.join(root, '_source.json') # '_' files are ignored by the Parquet reader
+    stamp = {'source': source, 'sha256': file_hash(source), 'version': CACHE_VERSION}
+    if os.path.exists(stamp_file):
+        with open(stamp_file) as f:
+            if json.load(f) == stamp:
+                return root
+    print(f"Building cache {root} from {source}")
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(root)
+    tasks = ((clean, chunk, root, partition_cols, i) for i, chunk in enumerate(read()))
+    for i, (rows, seconds) in enumerate(run_tasks(write_clean_chunk, tasks, workers)):
+        timings.append((f"clean {name}", f"chunk {i}", rows, seconds))
+    with open(stamp_file, 'w') as f:
+        json.dump(stamp, f)
+    return root
+
+# Files are named after the chunk number, so shards are always read back in the order of the source file
+def write_clean_chunk(clean, chunk, root, partition_cols, i):
+    clean(chunk).to_parquet(root, partition_cols=partition_cols, index=False,
+                            basename_template=f"chunk{i:05d}-{{i}}.parquet")
+    return len(chunk)
+
+# Reads only the requested columns and the partitions matching filters, e.g. [('Year', '==', 2022)]
+def read_cache_table(root, columns=None, filters=None):
+    dataset = ds.dataset(root, format='parquet', partitioning='hive')
+    expression = pq.filters_to_expression(filters) if filters else None
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+# Sorted (Year, Region) partitions of a cache entry
+def cache_shards(root):
+    shards = []
+    for year_dir in os.listdir(root):
+        if year_dir.startswith('Year='):
+            for region_dir in os.listdir(os.path.join(root, year_dir)):
+                shards.append((int(year_dir.split('=', 1)[1]), unquote(region_dir.split('=', 1)[1])))
+    return sorted(shards)
+
+# PAGE 3 PARTIAL AGGREGATES
+# A single groupby per (Year, Region) shard, at the finest key needed by the page-3 graphs, gives (sum, count)
+# partials per Year/Month. Shards are reduced in sorted order, and p3g1..p3g4 are all derived from the partials:
+# one scan of dfraw2 for graphs 1-2 and one scan of dfl for graphs 3-4.
+RAW_KEYS = ['Year', 'Month', 'Heure', 'Season']
+RAW_VALUES = ['Consumption_MWh', 'Production_MWh']
+LIGHT_KEYS = ['Year', 'Month']
+sectors = ['Nuclear', 'Hydro', 'Wind', 'Solar', 'Bioenergy', 'Thermal']
+
+def raw_partials(dfraw2):
+    values = dfraw2[RAW_VALUES].astype('float64')
+    return values.groupby([dfraw2[key] for key in RAW_KEYS], observed=True).agg(['sum', 'count'])
+
+def light_partials(dfl):
+    values = dfl[sectors].astype('float64')
+    return values.groupby([dfl[key] for key in LIGHT_KEYS], observed=True).agg(['sum', 'count'])
+
+def shard_filters(region_col, year, region, months=None):
+    filters = [('Year', '==', year), (region_col, '==', region)]
+    return filters + [('Month', 'in', months)] if months else filters
+
+def raw_shard_partials(root, year, region, months=None):
+    dfraw2 = read_cache_table(root, RAW_KEYS + RAW_VALUES, shard_filters('Région', year, region, months))
+    return raw_partials(dfraw2)
+
+def light_shard_partials(root, year, region, months=None):
+    dfl = read_cache_table(root, LIGHT_KEYS + sectors + flows, shard_filters('Region', year, region, months))
+    return light_partials(dfl), month_sketches(dfl, region)
+
+# Shard partials are concatenated in shard order, so each group is always summed in the same order
+def reduce_partials(parts):
+    acc = pd.concat(parts)
+    return acc.groupby(level=list(range(acc.index.nlevels)), observed=True).sum()
+
+# Graph 5 describes the distribution of each flow by region. Quantiles cannot be added like sums,
+# so each (Region, Flow) gets a KLL-style quantile sketch: level h keeps a sample of items of weight 2**h,
+# and a level over capacity is sorted and every other item is promoted to the next level.
+# Memory stays around 2/eps items per sketch whatever the history length, two sketches can be merged,
+# and quantiles are within about eps * n ranks (exact while nothing has been compacted).
+P3G5_EPS = 0.005
+
+class QuantileSketch:
+    def __init__(self, eps=P3G5_EPS):
+        self.eps = eps
+        self.k = max(8, int(np.ceil(2 / eps)))
+        self.levels = [np.empty(0)]
+        self.n = 0
+        self.total = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.flips = 0 # alternates which half of a compacted level is kept
+
+    def update(self, values):
+        values = np.asarray(values, dtype='float64')
+        values = values[~np.isnan(values)]
+        if len(values) > 0:
+            self.n += len(values)
+            self.total += values.sum()
+            self.min = min(self.min, values.min())
+            self.max = max(self.max, values.max())
+            self.levels[0] = np.concatenate([self.levels[0], values])
+            self.compress()
+        return self
+
+    def merge(self, other):
+        self.n += other.n
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for h, items in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[h] = np.concatenate([self.levels[h], items])
+        self.compress()
+        return self
+
+    def capacity(self, h):
+        return max(2, int(np.ceil(self.k * (2 / 3) ** (len(self.levels) - 1 - h))))
+
+    def compress(self):
+        while True:
+            full = [h for h, items in enumerate(self.levels) if len(items) > self.capacity(h)]
+            if not full:
+                return
+            h = full[0]
+            if h + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            items = np.sort(self.levels[h])
+            even = len(items) - len(items) % 2 # an odd item out stays at level h
+            promoted = items[:even][self.flips % 2::2]
+            self.flips += 1
+            self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+            self.levels[h] = items[even:]
+
+    def quantile(self, q):
+        if self.n == 0:
+            return np.nan
+        if len(self.levels) == 1:
+            return np.quantile(self.levels[0], q) # exact, same interpolation as pandas
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items_h), 2.0 ** h) for h, items_h in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        cumulated = np.cumsum(weights[order])
+        return items[order][np.searchsorted(cumulated, q * cumulated[-1])]
+
+    def mean(self):
+        return self.total / self.n if self.n else np.nan
+
+    def to_state(self):
+        meta = {'eps': self.eps, 'n': self.n, 'total': self.total, 'min': self.min, 'max': self.max,
+                'flips': self.flips, 'sizes': [len(items) for items in self.levels]}
+        return meta, np.concatenate(self.levels)
+
+    @classmethod
+    def from_state(cls, meta, values):
+        sketch = cls(meta['eps'])
+        sketch.n, sketch.total, sketch.min, sketch.max, sketch.flips = (
+            meta['n'], meta['total'], meta['min'], meta['max'], meta['flips'])
+        sketch.levels = np.split(values, np.cumsum(meta['sizes'])[:-1])
+        return sketch
+
+# One fresh sketch per (Year, Month, Region, Flow)
+def month_sketches(dfl, region):
+    return {(int(year), int(month), region, flow): QuantileSketch().update(group[flow].to_numpy())
+            for (year, month), group in dfl.groupby(['Year', 'Month'], observed=True) for flow in flows}
+
+# Month sketches are merged into the (Region, Flow) sketches in chronological order, and can then be dropped
+def fold_sketches(sketches, parts):
+    for key in sorted(parts):
+        year, month, region, flow = key
+        if (region, flow) in sketches:
+            sketches[(region, flow)].merge(parts[key])
+        else:
+            sketches[(region, flow)] = parts[key]
+    return sketches
+
+# Mean per group from the partials, rolled up to the keys in `by`
+def final_mean(acc, by):
+    acc = acc.groupby(level=by, observed=True).sum()
+    return (acc.xs('sum', axis=1, level=1) / acc.xs('count', axis=1, level=1)).reset_index()
+
+# Sum in TWh per group (half-hourly MW * 0.5 / 1000000), rolled up to the keys in `by`
+def final_twh(acc, by):
+    return acc.xs('sum', axis=1, level=1).groupby(level=by, observed=True).sum().mul(0.5).div(1000000)
+
+# INCREMENTAL REBUILD
+# The partials are stored next to the CSVs, in PARTIALS_DIR, with a fingerprint (rows, content hash) of each
+# (Year, Month, Region) of the cache. Months that are new, changed (e.g. a month that was only partly
+# exported) or gone are dropped from the stored partials and aggregated again, and p3g1..p3g5 are
+# regenerated from the stored partials. Since every month is aggregated the same way in both modes,
+# the outputs are identical to a full rebuild.
+# Sketches cannot be un-merged: the months before the last one are folded into the stored sketches,
+# the last month (the one most likely to change) is kept as month sketches. If a month older than the
+# last stored one changes (or P3G5_EPS changed), everything is rebuilt.
+# Run with --full (or set P3_INCREMENTAL = False) to force a full rebuild.
+PARTIALS_DIR = 'light_partials'
+P3_INCREMENTAL = True
+
+def flatten_columns(acc):
+    acc = acc.copy()
+    acc.columns = [f"{col}|{stat}" for col, stat in acc.columns]
+    return acc
+
+def unflatten_columns(acc):
+    acc.columns = pd.MultiIndex.from_tuples([tuple(col.split('|')) for col in acc.columns])
+    return acc
+
+RAW_PARTIALS = os.path.join(PARTIALS_DIR, 'raw.parquet')
+LIGHT_PARTIALS = os.path.join(PARTIALS_DIR, 'light.parquet')
+SKETCHES_JSON = os.path.join(PARTIALS_DIR, 'sketches.json')
+SKETCHES_NPZ = os.path.join(PARTIALS_DIR, 'sketches.npz')
+RAW_MONTHS = os.path.join(PARTIALS_DIR, 'raw_months.json')
+LIGHT_MONTHS = os.path.join(PARTIALS_DIR, 'light_months.json')
+
+def save_raw_partials(raw_acc):
+    os.makedirs(PARTIALS_DIR, exist_ok=True)
+    flatten_columns(raw_acc).to_parquet(RAW_PARTIALS)
+
+def load_raw_partials():
+    if not os.path.exists(RAW_PARTIALS):
+        return None
+    return unflatten_columns(pd.read_parquet(RAW_PARTIALS))
+
+# `sketches` are the (Region, Flow) sketches of the months before the last one, `held` the
+# (Year, Month, Region, Flow) sketches of the last month
+def save_light_partials(light_acc, sketches, held):
+    os.makedirs(PARTIALS_DIR, exist_ok=True)
+    flatten_columns(light_acc).to_parquet(LIGHT_PARTIALS)
+    states = {'|'.join(str(label) for label in (kind,) + key): sketch.to_state()
+              for kind, group in [('closed', sketches), ('held', held)] for key, sketch in group.items()}
+    np.savez(SKETCHES_NPZ, **{key: values for key, (meta, values) in states.items()})
+    with open(SKETCHES_JSON, 'w') as f:
+        json.dump({'eps': P3G5_EPS, 'sketches': {key: meta for key, (meta, values) in states.items()}}, f)
+
+def load_light_state():
+    try:
+        light_acc = unflatten_columns(pd.read_parquet(LIGHT_PARTIALS))
+        with open(SKETCHES_JSON) as f:
+            stored = json.load(f)
+        values = np.load(SKETCHES_NPZ)
+    except FileNotFoundError:
+        return None
+    if stored['eps'] != P3G5_EPS:
+        return None
+    sketches, held = {}, {}
+    for key, meta in stored['sketches'].items():
+        kind, *labels = key.split('|')
+        if kind == 'closed':
+            sketches[tuple(labels)] = QuantileSketch.from_state(meta, values[key])
+        elif kind == 'held':
+            year, month, region, flow = labels
+            held[(int(year), int(month), region, flow)] = QuantileSketch.from_state(meta, values[key])
+        else: # sketches stored before the last month was held apart
+            return None
+    return light_acc, sketches, held
+
+# Partials and (Region, Flow) sketches of every month
+def load_light_partials():
+    state = load_light_state()
+    if state is None:
+        return None
+    light_acc, sketches, held = state
+    return light_acc, fold_sketches(sketches, held)
+
+# Rows and content hash of each (Year, Month) of a shard. Row hashes are summed modulo 2**64,
+# so the fingerprint does not depend on the order of the rows within the month.
+def shard_fingerprints(root, region_col, columns, year, region):
+    df = read_cache_table(root, columns, shard_filters(region_col, year, region))
+    hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    periods = df['Year'].astype('int64').to_numpy() * 100 + df['Month'].astype('int64').to_numpy()
+    keys, inverse, rows = np.unique(periods, return_inverse=True, return_counts=True)
+    sums = np.zeros(len(keys), dtype='uint64')
+    np.add.at(sums, inverse, hashes)
+    return {(int(key // 100), int(key % 100), region): [int(n), int(h)] for key, n, h in zip(keys, rows, sums)}
+
+# {(Year, Month, Region): [rows, hash]} of the columns read by the partials
+def month_fingerprints(root, region_col, columns, workers=None):
+    tasks = [(root, region_col, columns, year, region) for year, region in cache_shards(root)]
+    fingerprints = {}
+    for (root, region_col, columns, year, region), (part, seconds) in zip(tasks, run_tasks(shard_fingerprints, tasks, workers)):
+        timings.append((f"fingerprint {os.path.basename(root)}", f"{year} {region}",
+                        sum(rows for rows, h in part.values()), seconds))
+        fingerprints.update(part)
+    return fingerprints
+
+def save_fingerprints(path, fingerprints):
+    with open(path, 'w') as f:
+        json.dump({'|'.join(str(label) for label in key): value for key, value in sorted(fingerprints.items())}, f)
+
+def load_fingerprints(path):
+    try:
+        with open(path) as f:
+            stored = json.load(f)
+    except FileNotFoundError:
+        return None
+    return {(int(year), int(month), region): value
+            for key, value in stored.items() for year, month, region in [key.split('|', 2)]}
+
+# Sorted (Year, Month) periods that are new, changed or gone in a region
+def changed_periods(current, stored):
+    return sorted({key[:2] for key in set(current) | set(stored) if current.get(key) != stored.get(key)})
+
+def period_mask(acc, periods):
+    index = pd.MultiIndex.from_arrays([acc.index.get_level_values('Year').astype(int),
+                                       acc.index.get_level_values('Month').astype(int)])
+    return index.isin(periods)
+
+# (root, year, region, months) tasks covering the given periods (all periods if None)
+def shard_tasks(root, periods=None):
+    if periods is None:
+        return [(root, year, region, None) for year, region in cache_shards(root)]
+    return [(root, year, region, sorted(month for y, month in periods if y == year))
+            for year, region in cache_shards(root) if year in {y for y, month in periods}]
+
+def aggregate_raw(root, periods=None, workers=None):
+    tasks = shard_tasks(root, periods)
+    raw_parts = []
+    for (root, year, region, months), (part, seconds) in zip(tasks, run_tasks(raw_shard_partials, tasks, workers)):
+        timings.append(("aggregate dfraw2", f"{year} {region}", len(part), seconds))
+        raw_parts.append(part)
+    return reduce_partials(raw_parts)
+
+# Shards arrive in (Year, Region) order, so the months of each (Region, Flow) come in chronological order:
+# they are folded into `sketches` as soon as their shard is done, and memory does not grow with the history.
+# The month sketches of the period `hold` are returned apart instead.
+def aggregate_light(root, periods=None, workers=None, sketches=None, hold=None):
+    tasks = shard_tasks(root, periods)
+    light_parts, sketches, held = [], {} if sketches is None else sketches, {}
+    for (root, year, region, months), ((light_part, sketch_part), seconds) in zip(tasks, run_tasks(light_shard_partials, tasks, workers)):
+        timings.append(("aggregate dfl", f"{year} {region}", len(light_part), seconds))
+        light_parts.append(light_part)
+        held.update({key: sketch for key, sketch in sketch_part.items() if key[:2] == hold})
+        fold_sketches(sketches, {key: sketch for key, sketch in sketch_part.items() if key[:2] != hold})
+    return reduce_partials(light_parts), sketches, held
+
+# Loads the stored partials and aggregates again the new or changed months, or rebuilds everything
+def update_raw_partials(raw_cache, incremental=P3_INCREMENTAL, workers=None):
+    current = month_fingerprints(raw_cache, 'Région', RAW_KEYS + RAW_VALUES, workers)
+    raw_acc = load_raw_partials() if incremental else None
+    stored = None if raw_acc is None else load_fingerprints(RAW_MONTHS)
+    if stored is None:
+        print("Full rebuild of the dfraw2 partials")
+        raw_acc = aggregate_raw(raw_cache, workers=workers)
+    else:
+        changed = changed_periods(current, stored)
+        if not changed:
+            return raw_acc
+        print(f"Aggregating {len(changed)} new or changed month(s) of dfraw2")
+        present = [period for period in changed if period in {key[:2] for key in current}]
+        parts = [raw_acc[~period_mask(raw_acc, changed)]]
+        if present:
+            parts.append(aggregate_raw(raw_cache, present, workers))
+        raw_acc = pd.concat(parts).sort_index()
+    save_raw_partials(raw_acc)
+    save_fingerprints(RAW_MONTHS, current)
+    return raw_acc
+
+def update_light_partials(light_cache, incremental=P3_INCREMENTAL, workers=None):
+    current = month_fingerprints(light_cache, 'Region', LIGHT_KEYS + sectors + flows, workers)
+    last = max(key[:2] for key in current)
+    state = load_light_state() if incremental else None
+    stored = None if state is None else load_fingerprints(LIGHT_MONTHS)
+    changed = [] if stored is None else changed_periods(current, stored)
+    held_period = None if stored is None else max(key[:2] for key in stored)
+    if stored is None or changed and (changed[0] < held_period or last < held_period):
+        print("Full rebuild of the dfl partials")
+        light_acc, sketches, held = aggregate_light(light_cache, workers=workers, hold=last)
+    elif changed:
+        print(f"Aggregating {len(changed)} new or changed month(s) of dfl")
+        light_acc, sketches, held = state
+        if held_period not in changed:
+            fold_sketches(sketches, held)
+        new_light_acc, sketches, held = aggregate_light(light_cache, changed, workers, sketches, hold=last)
+        light_acc = pd.concat([light_acc[~period_mask(light_acc, changed)], new_light_acc]).sort_index()
+    else:
+        light_acc, sketches, held = state
+        return light_acc, fold_sketches(sketches, held)
+    save_light_partials(light_acc, sketches, held)
+    save_fingerprints(LIGHT_MONTHS, current)
+    return light_acc, fold_sketches(sketches, held)
+
+# PARALLEL ETL
+# Cleaning (chunk by chunk, while the CSV is being read) and aggregation (Region x Year shard by shard)
+# run in a pool of ETL_WORKERS processes. Results are collected in submission order, so the reduce
+# is the same whatever the number of workers. Every task is timed and the timings are reported at the end.
+ETL_WORKERS = os.cpu_count() # 1 runs everything in the main process
+timings = [] # (stage, shard, rows, seconds)
+
+def timed(task, args):
+    start = time.perf_counter()
+    result = task(*args)
+    return result, time.perf_counter() - start
+
+# Yields (result, seconds) in the order of `tasks`, with at most 2 tasks per worker in flight
+def run_tasks(task, tasks, workers=None):
+    workers = workers or ETL_WORKERS
+    if workers == 1:
+        for args in tasks:
+            yield timed(task, args)
+        return
+    # spawned workers import this module without running it, and are safe to start from the runner threads
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        pending = deque()
+        for args in tasks:
+            pending.append(pool.submit(timed, task, args))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def report_timings(path=os.path.join(CACHE_DIR, 'timings.csv')):
+    report = pd.DataFrame(timings, columns=['Stage', 'Shard', 'Rows', 'Seconds'])
+    if len(report) == 0:
+        return report
+    for stage, times in report.groupby('Stage', sort=False):
+        slowest = times.loc[times['Seconds'].idxmax()]
+        print(f"{stage}: {len(times)} tasks, {times['Seconds'].sum():.2f} s of work, "
+              f"slowest {slowest['Shard']} ({slowest['Seconds']:.2f} s)")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    report.to_csv(path, index=False)
+    print(f"Per-shard timings written to {path}")
+    return report
+
+# Now we proceed to data generation from s3, following a normal distribution
+# but keeping extreme values (min and max).
+# All (Region, Flow) groups are drawn at once in a (groups, P3G5_SAMPLES) array, from a seeded generator
+P3G5_SAMPLES = 18 # synthetic values per group, on top of min and max
+P3G5_SEED = 42
+P3G5_TOLERANCE = 0.1 # accepted gap between s5 and s3, as a share of the group range (max - min)
+stats = ['min', 'q2', 'mean', 'q3', 'max']
+
+def generate_synthetic_data(s3, num_samples=P3G5_SAMPLES, seed=P3G5_SEED):
+    rng = np.random.default_rng(seed)
+    mean = s3['mean'].to_numpy()[:, None]
+    # Approximate standard deviation using IQR
+    std_dev = (s3['q3'] - s3['q2']).to_numpy()[:, None] / 1.349  # Approximation for normal distribution
+    synthetic_data = rng.normal(mean, std_dev, (len(s3), num_samples))
+    # Add min and max values
+    return np.column_stack([synthetic_data, s3['min'], s3['max']])
+
+# Same statistics as s3, computed row-wise on the synthetic array
+def describe_synthetic_data(s3, values):
+    s5 = s3[['Region', 'Flow']].copy()
+    s5['min'] = values.min(axis=1)
+    s5['q2'] = np.quantile(values, 0.5, axis=1)
+    s5['mean'] = values.mean(axis=1)
+    s5['q3'] = np.quantile(values, 0.75, axis=1)
+    s5['max'] = values.max(axis=1)
+    return s5
+
+def check_synthetic_data(s3, s5, tolerance=P3G5_TOLERANCE):
+    span = (s3['max'] - s3['min']).replace(0, 1).to_numpy()[:, None]
+    gap = (s5[stats] - s3[stats]).abs() / span
+    failed = s3.loc[(gap > tolerance).any(axis=1), ['Region', 'Flow']]
+    if len(failed):
+        warnings.warn(f"Synthetic data differ from s3 by more than {tolerance:.0%} of the range for:\n{failed}")
+    return gap
+
+
+# PAGE 1 DATASET 1
+# Missing values by variable in the raw dataset, as first loaded (default NA parsing: 'ND' is not counted)
+P1D1_TRANSLATIONS = ['RegionID', 'Region', 'Nature', 'Date', 'Hour', 'Date_Hour', 'Consumption', 'Thermal',
+                     'Nuclear', 'Wind', 'Solar', 'Hydro', 'Pumping consumption', 'Bioenergy', 'Exchange_balance',
+                     'Battery storage', 'Déstockage batterie', 'Eolien terrestre', 'Eolien offshore',
+                     'Thermal_TCO', 'Thermal_TCH', 'Nuclear_TCO', 'Nuclear_TCH', 'Wind_TCO', 'Wind_TCH',
+                     'Solar_TCO', 'Solar_TCH', 'Hydro_TCO', 'Hydro_TCH', 'Bioenergy_TCO', 'Bioenergy_TCH',
+                     'Column 30']
+
+def count_missing_values(path=RAW_FILE, chunksize=RAW_CHUNKSIZE):
+    missing, rows = None, 0
+    for chunk in pd.read_csv(path, sep = ';', chunksize=chunksize):
+        missing = chunk.isna().sum() if missing is None else missing + chunk.isna().sum()
+        rows += len(chunk)
+    p1d1nans = pd.DataFrame({'Translation': P1D1_TRANSLATIONS[:len(missing)],
+                             'Missing Values': missing.to_numpy()})
+    p1d1nans['Ratio'] = (100 * p1d1nans['Missing Values'] / rows).map('{:.0f} %'.format)
+    return p1d1nans
+
+# PAGE 1 NAN MASKS
+# Heatmaps of missing values in the raw dataset: the isna() mask of each chunk is kept bit-packed per year
+# (one bit per row and column), then downsampled to NAN_MASK_BINS row bins, a bin being missing when
+# most of its rows are. The result is bit-packed again: a few KB for all years.
+NAN_MASKS = 'p1nanmasks.npz'
+NAN_MASK_BINS = 400
+
+def downsample_mask(mask, bins=NAN_MASK_BINS):
+    edges = np.linspace(0, len(mask), min(bins, len(mask)) + 1).astype('int64')
+    missing = np.add.reduceat(mask.astype('int32'), edges[:-1], axis=0)
+    binned = 2 * missing >= np.diff(edges)[:, None]
+    return np.pad(binned, ((0, bins - len(binned)), (0, 0)))
+
+def year_nan_masks(path=RAW_FILE, chunksize=RAW_CHUNKSIZE):
+    packed = {}
+    for chunk in pd.read_csv(path, sep = ';', chunksize=chunksize):
+        years = chunk['Date'].str[:4].astype('int16').to_numpy()
+        mask = chunk.isna().to_numpy()
+        for year in np.unique(years):
+            rows = mask[years == year]
+            packed.setdefault(year, []).append((np.packbits(rows, axis=0), len(rows)))
+    columns = P1D1_TRANSLATIONS[:mask.shape[1]]
+    masks = [downsample_mask(np.concatenate([np.unpackbits(bits, axis=0, count=n) for bits, n in packed[year]]))
+             for year in sorted(packed)]
+    return sorted(packed), columns, np.packbits(np.stack(masks), axis=1)
+
+def save_nan_masks(path=NAN_MASKS):
+    years, columns, masks = year_nan_masks()
+    np.savez_compressed(path, years=np.array(years, dtype='int16'), columns=np.array(columns),
+                        bins=NAN_MASK_BINS, masks=masks)
+
+# DATA QUALITY
+# Every dataset is laid out on a dense Region x time slot grid: np.bincount gives the number of rows
+# in each cell, so empty cells are gaps and cells counted more than once are duplicates.
+# Gaps are reported as runs of consecutive empty slots, with the NaN rate per column and per year.
+QUALITY_DIR = 'light_quality'
+
+def slot_counts(region, timestamp, freq):
+    region = region.astype('category')
+    start = timestamp.min().floor('D')
+    slots = ((timestamp - start) // pd.Timedelta(freq)).to_numpy()
+    n_regions, n_slots = len(region.cat.categories), int(slots.max()) + 1
+    cells = region.cat.codes.to_numpy().astype('int64') * n_slots + slots
+    counts = np.bincount(cells, minlength=n_regions * n_slots).reshape(n_regions, n_slots)
+    return counts, region.cat.categories, start
+
+# Runs of empty cells, row by row: (row, first slot, number of slots)
+def gap_runs(counts):
+    missing = np.pad(counts == 0, ((0, 0), (1, 1))).astype('int8')
+    edges = np.diff(missing, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[1] # same row-major order as the starts
+    return rows, starts, ends - starts
+
+def check_grid(dataset, region, timestamp, freq):
+    counts, regions, start = slot_counts(region, timestamp, freq)
+    step = pd.Timedelta(freq)
+    rows, starts, lengths = gap_runs(counts)
+    gaps = pd.DataFrame({'Dataset': dataset, 'Region': regions[rows],
+                         'Start': start + starts * step, 'End': start + (starts + lengths - 1) * step,
+                         'Missing slots': lengths})
+    rows, slots = np.nonzero(counts > 1)
+    duplicates = pd.DataFrame({'Dataset': dataset, 'Region': regions[rows],
+                               'Timestamp': start + slots * step, 'Rows': counts[rows, slots]})
+    missing_everywhere = np.nonzero((counts == 0).all(axis=0))[0]
+    print(f"{dataset}: {counts.shape[0]} regions x {counts.shape[1]} slots, {len(gaps)} gaps "
+          f"({lengths.sum()} missing cells, {len(missing_everywhere)} slots missing in every region), "
+          f"{len(duplicates)} duplicated cells")
+    return gaps, duplicates
+
+def nan_rates(dataset, df, year, columns):
+    rates = df[columns].isna().groupby(year).mean().round(4)
+    rates.index.name = 'Year'
+    rates = rates.reset_index().melt(id_vars='Year', var_name='Column', value_name='NaN rate')
+    return rates.assign(Dataset=dataset)[['Dataset', 'Year', 'Column', 'NaN rate']]
+
+def check_raw(root):
+    dfraw2 = read_cache_table(root, ['Région', 'Date', 'Heure', 'Year'] + RAW_MW_COLS)
+    heure = dfraw2['Heure'].astype('category')
+    minutes = heure.cat.categories.str.slice(0, 2).astype(int) * 60 + heure.cat.categories.str.slice(3, 5).astype(int)
+    timestamp = dfraw2['Date'] + pd.to_timedelta(np.asarray(minutes)[heure.cat.codes], unit='min')
+    gaps, duplicates = check_grid('eco2mix', dfraw2['Région'], timestamp, '30min')
+    return gaps, duplicates, nan_rates('eco2mix', dfraw2, dfraw2['Year'], RAW_MW_COLS)
+
+def check_temperature(path=TEMP_FILE):
+    temp_cols = ['TMin (°C)', 'TMax (°C)', 'TMoy (°C)']
+    temp = pd.read_csv(path, sep = ';', usecols=['Date', 'Région'] + temp_cols, dtype={'Région': 'category'})
+    temp['Date'] = pd.to_datetime(temp['Date'])
+    gaps, duplicates = check_grid('temperature', temp['Région'], temp['Date'], '1D')
+    return gaps, duplicates, nan_rates('temperature', temp, temp['Date'].dt.year, temp_cols)
+
+QUALITY_OUTPUTS = [os.path.join(QUALITY_DIR, f"{name}.csv") for name in ['gaps', 'duplicates', 'nan_rates']]
+
+def build_quality(options):
+    reports = zip(check_raw(os.path.join(CACHE_DIR, 'dfraw2')), check_temperature())
+    os.makedirs(QUALITY_DIR, exist_ok=True)
+    for path, (raw_report, temp_report) in zip(QUALITY_OUTPUTS, reports):
+        pd.concat([raw_report, temp_report], ignore_index=True).to_csv(path, sep=',', index=False)
+
+# TEMPERATURE JOIN
+# Daily temperatures are laid out as a dense (region, day) table: one row per INSEE region code, one column
+# per day since the first temperature date. Each half-hourly row picks its values with a single integer lookup
+# instead of a merge on (Region, Date) strings, keyed on the INSEE code kept in the dfraw2 cache.
+# Rows without a temperature record are reported as unmatched.
+TEMP_COLUMNS = {'TMin (°C)': 'TMin', 'TMax (°C)': 'TMax', 'TMoy (°C)': 'TAvg'}
+TEMP_FEATURES = ['TMin', 'TMax', 'TAvg', 'DJU']
+DJU_BASE = 18 # heating degree days: DJU = max(18 - TAvg, 0)
+FEATURES_DIR = os.path.join(CACHE_DIR, 'features')
+FEATURES_COLUMNS = ['Year', 'Code INSEE région', 'Région', 'Date', 'Heure', 'Month', 'Season', 'Consommation (MW)']
+UNMATCHED_DATES = os.path.join(QUALITY_DIR, 'temperature_unmatched.csv')
+
+def temperature_table(path=TEMP_FILE):
+    temp = pd.read_csv(path, sep = ';', usecols=['Date', 'Code INSEE région'] + list(TEMP_COLUMNS),
+                       dtype={column: 'float32' for column in TEMP_COLUMNS})
+    dates = pd.to_datetime(temp['Date'])
+    start = dates.min()
+    days = ((dates - start) // pd.Timedelta('1D')).to_numpy()
+    codes = temp['Code INSEE région'].to_numpy()
+    regions = np.unique(codes)
+    rows = np.full(regions.max() + 1, -1, dtype='int64') # INSEE code -> table row
+    rows[regions] = np.arange(len(regions))
+    table = np.full((len(regions), days.max() + 1, len(TEMP_FEATURES)), np.nan, dtype='float32')
+    present = np.zeros(table.shape[:2], dtype=bool)
+    table[rows[codes], days, :3] = temp[list(TEMP_COLUMNS)].to_numpy()
+    table[..., 3] = np.maximum(DJU_BASE - table[..., 2], 0)
+    present[rows[codes], days] = True
+    return rows, start, table, present
+
+def join_temperature(df, rows, start, table, present):
+    codes = df['Code INSEE région'].to_numpy().astype('int64')
+    days = ((df['Date'] - start) // pd.Timedelta('1D')).to_numpy()
+    regions = rows[np.clip(codes, 0, len(rows) - 1)]
+    matched = (codes >= 0) & (codes < len(rows)) & (regions >= 0) & (days >= 0) & (days < table.shape[1])
+    matched[matched] = present[regions[matched], days[matched]]
+    values = np.full((len(df), len(TEMP_FEATURES)), np.nan, dtype='float32')
+    values[matched] = table[regions[matched], days[matched]]
+    return df.assign(**dict(zip(TEMP_FEATURES, values.T))), matched
+
+# Each task writes a single (Year, Région) partition of the features cache
+def join_shard(root, year, region, temperature):
+    df = read_cache_table(root, FEATURES_COLUMNS, shard_filters('Région', year, region))
+    df, matched = join_temperature(df, *temperature)
+    df.to_parquet(FEATURES_DIR, partition_cols=['Year', 'Région'], index=False, basename_template="part-{i}.parquet")
+    return len(df), df.loc[~matched, ['Région', 'Date']].drop_duplicates()
+
+def build_features(root, workers=None):
+    temperature = temperature_table()
+    shutil.rmtree(FEATURES_DIR, ignore_errors=True)
+    tasks = [(root, year, region, temperature) for year, region in cache_shards(root)]
+    rows, unmatched = 0, []
+    for (root, year, region, temperature), ((n, missing), seconds) in zip(tasks, run_tasks(join_shard, tasks, workers)):
+        timings.append(("join temperature", f"{year} {region}", n, seconds))
+        rows += n
+        unmatched.append(missing)
+    unmatched = pd.concat(unmatched, ignore_index=True).astype({'Région': str}).sort_values(['Région', 'Date'])
+    print(f"temperature join: {rows} rows, {len(unmatched)} region-days without temperature")
+    os.makedirs(QUALITY_DIR, exist_ok=True)
+    unmatched.to_csv(UNMATCHED_DATES, sep=',', index=False)
+
+# IMAGES
+# The PNG screenshots shown in the app are converted to WebP (and AVIF when Pillow supports it) at the
+# width they are displayed at. File names carry a hash of the content, so browsers can cache them for good.
+# They are written to static/, served by Streamlit (enableStaticServing), and listed in static/images.json.
+IMAGE_SOURCES = ['Image1.png', 'Image2.png', 'Image3.png', 'Image4.png', 'Image5.png',
+                 'feature_1.png', 'feature_2.png', 'feature_3.png', 'feature_4.png',
+                 'Tests_1.png', 'Tests_2.png', 'Tests_3.png', 'Tests_4.png',
+                 'Performace_RandomForrest.png', 'feature_importance.png',
+                 'heatmap_nans_1.png', 'heatmap_nans_2.png', 'heatmap_nans_3.png']
+IMAGE_DIR = 'static'
+IMAGE_MANIFEST = os.path.join(IMAGE_DIR, 'images.json')
+IMAGE_WIDTH = 800
+IMAGE_FORMATS = {'avif': dict(quality=70), 'webp': dict(quality=85, method=6)}
+
+def image_variants(path, width=IMAGE_WIDTH):
+    image = Image.open(path)
+    if image.width > width:
+        image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+    variants = {'width': image.width, 'height': image.height}
+    for fmt, params in IMAGE_FORMATS.items():
+        if not features.check(fmt):
+            continue
+        buffer = io.BytesIO()
+        image.save(buffer, fmt.upper(), **params)
+        data = buffer.getvalue()
+        name = f"{os.path.splitext(path)[0]}.{hashlib.sha256(data).hexdigest()[:12]}.{fmt}"
+        with open(os.path.join(IMAGE_DIR, name), 'wb') as f:
+            f.write(data)
+        variants[fmt] = name
+    return variants
+
+def save_images():
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    manifest = {path: image_variants(path) for path in IMAGE_SOURCES}
+    current = {name for variants in manifest.values() for fmt, name in variants.items() if fmt in IMAGE_FORMATS}
+    for name in os.listdir(IMAGE_DIR): # variants of previous versions of the images
+        if name.endswith(tuple(IMAGE_FORMATS)) and name not in current:
+            os.remove(os.path.join(IMAGE_DIR, name))
+    with open(IMAGE_MANIFEST, 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+# ETL NODES
+# Each output is a node, built from source files and from the outputs of other nodes, which exchange data
+# through files. build(options) writes the node outputs.
+def build_p1d1nans(options):
+    count_missing_values().to_csv("p1d1nans.csv", sep=',', index=False)
+
+def build_p1nanmasks(options):
+    save_nan_masks()
+
+def build_images(options):
+    save_images()
+
+def build_raw_cache(options):
+    build_cache('dfraw2', RAW_FILE, read_raw, clean_raw, ['Year', 'Région'], options.workers)
+
+def build_light_cache(options):
+    build_cache('dfl', LIGHT_FILE, read_light, clean_light, ['Year', 'Region'], options.workers)
+
+def build_temperature_join(options):
+    build_features(os.path.join(CACHE_DIR, 'dfraw2'), options.workers)
+
+def build_raw_partials(options):
+    update_raw_partials(os.path.join(CACHE_DIR, 'dfraw2'), not options.full, options.workers)
+
+def build_light_partials(options):
+    update_light_partials(os.path.join(CACHE_DIR, 'dfl'), not options.full, options.workers)
 
 # PAGE 3 GRAPH 1
-gbraw= dfraw2.groupby('Month', as_index = False)[['Consumption_MWh', 'Production_MWh']].mean().round()
-p3g1 = gbraw.copy()
-p3g1.to_csv("p3g1.csv", sep=',', index=False)
+def build_p3g1(options):
+    gbraw = final_mean(load_raw_partials(), 'Month').round()
+    p3g1 = gbraw.copy()
+    p3g1.to_csv("p3g1.csv", sep=',', index=False)
 
 # PAGE 3 GRAPH 2
-gb2raw= dfraw2.groupby(['Heure', 'Season'], as_index = False)[['Consumption_MWh']].mean().round()
-p3g2 = gb2raw.copy()
-p3g2.to_csv("p3g2.csv", sep=',', index=False)
+def build_p3g2(options):
+    gb2raw = final_mean(load_raw_partials()[['Consumption_MWh']], ['Heure', 'Season']).round()
+    p3g2 = gb2raw.copy()
+    p3g2.to_csv("p3g2.csv", sep=',', index=False)
 
 # PAGE 3 GRAPH 3
-dfl_2022 = dfl[dfl['Year'] == 2022]
-
-# Create gbs (groupby "small") With groupby (by Month) and melt it by month/secto
-gbs = dfl_2022.groupby('Month')[['Nuclear', 'Hydro', 'Wind', 'Solar', 'Bioenergy', 'Thermal'] 
-                                ].sum().mul(0.5).div(1000000).round(1).reset_index()
-p3g3 = gbs.copy()
-p3g3.to_csv("p3g3.csv", sep=',', index=False)
-p3g3.info()
+def build_p3g3(options):
+    light_acc, sketches = load_light_partials()
+    # Create gbs (groupby "small"): monthly production by sector in 2022, taken from the (Year, Month) partials
+    gbs = final_twh(light_acc.xs(2022, level='Year', drop_level=False), 'Month').round(1).reset_index()
+    p3g3 = gbs.copy()
+    p3g3.to_csv("p3g3.csv", sep=',', index=False)
 
 # PAGE 3 GRAPH 4
-gbt = dfl.groupby('Year')[ 
-    ['Nuclear', 'Hydro', 'Wind', 'Solar', 'Bioenergy', 'Thermal'] 
-    ].sum().mul(0.5).div(1000000).round().reset_index() # replacing * 0.5 / 1000000
-p3g4 = gbt.copy()
-p3g4.to_csv("p3g4.csv", sep=',', index=False)
+def build_p3g4(options):
+    light_acc, sketches = load_light_partials()
+    gbt = final_twh(light_acc, 'Year').round().reset_index() # replacing * 0.5 / 1000000
+    p3g4 = gbt.copy()
+    p3g4.to_csv("p3g4.csv", sep=',', index=False)
 
 # PAGE 3 GRAPH 5
-# First approach creates a dataset of shape (4207104, 3), too big.
+def build_p3g5(options):
+    light_acc, sketches = load_light_partials()
+    # First approach melted dfl into a dataset of shape (4207104, 3), too big, and sorted every group for q2 / q3.
+    # Instead, we characterize the distribution of variables by region and for each flow from the sketches
+    s3 = pd.DataFrame([{'Region': region, 'Flow': flow,
+                        'min': sketch.min, 'q2': sketch.quantile(0.5), 'mean': sketch.mean(),
+                        'q3': sketch.quantile(0.75), 'max': sketch.max}
+                       for (region, flow), sketch in sorted(sketches.items())])
+    # s3.to_csv("p3g5.csv", sep=',', index=False)
 
-s1 = pd.melt(dfl, id_vars="Region", 
-             value_vars=['ConsumptionMWh', 'ProductionMWh'],
-             var_name='Flow', value_name='Value')
-s1.info()
+    synthetic_values = generate_synthetic_data(s3)
 
-# But from this melted dataframe we can characterize the distribution
-# of variables by region and for each flow, for future reference
-def q2(x):
-    return x.quantile(0.5)
+    # Create a new DataFrame with synthetic data
+    s4 = pd.DataFrame({'Region': np.repeat(s3['Region'].to_numpy(), synthetic_values.shape[1]),
+                       'Flow': np.repeat(s3['Flow'].to_numpy(), synthetic_values.shape[1]),
+                       'Value': synthetic_values.ravel()})
 
-def q3(x):
-    return x.quantile(0.75)
+    # Check that the distribution matches the initial distribution closely
+    # by comparing s5 to s3
+    s5 = describe_synthetic_data(s3, synthetic_values)
+    gap = check_synthetic_data(s3, s5)
+    print(f"p3g5: {len(s4)} synthetic values, largest gap to s3 {gap.to_numpy().max():.1%} of the range")
 
-s2 = s1.groupby(['Region', 'Flow'])['Value'].agg(['min', q2, 'mean', q3, 'max'])
-s3 = s2.reset_index()
-# s3.to_csv("p3g5.csv", sep=',', index=False)
-s3.shape
+    # If so, we are confident we can export s4 as p3g5 for Streamlit
+    s4.to_csv("p3g5.csv", sep=',', index=False)
 
-# Now we proceed to data generation from s3, following a normal distribution
-# but keeping extreme values (min and max)
+# PAGE 3 FIGURES
+# The page-3 charts are written as ready-to-render Plotly figures in one JSON file: data already melted,
+# labelled and rounded to display precision, without the default template (Streamlit applies its theme).
+# The app only loads them.
+P3_FIGURES = 'p3figures.json'
+GRID = dict(showgrid=True, gridcolor="gray", gridwidth=1, griddash="dot")
+PLOT_BGCOLOR = "rgba(240, 242, 246, 0.8)"
+SECTOR_COLORS = {'Nuclear': '#5603AD', 'Hydro': '#1E96FC', 'Wind': '#5DD39E',
+                 'Solar': '#FFD333', 'Bioenergy': '#FE938C', 'Thermal': '#27313F'}
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+          'August', 'September', 'October', 'November', 'December']
+MONTH_LABELS = ['Jan.', 'Feb.', 'March', 'April', 'May', 'June', 'July', 'Aug.', 'Sept.', 'Oct.', 'Nov.', 'Dec.']
+P3G5_REGION_ORDER = ["Auvergne-Rhone-Alpes", "Grand Est", "Centre-Val de Loire", "Normandie", "Nouvelle-Aquitaine",
+                     "Hauts-de-France", "Occitanie", "Provence-Alpes-Cote d'Azur", "Pays de la Loire",
+                     "Bretagne", "Bourgogne-Franche-Comte", "Ile-de-France"]
 
-# Function to generate synthetic data
-def generate_synthetic_data(row, num_samples=18):
-    mean = row['mean']
-    # Approximate standard deviation using IQR
-    iqr = row['q3'] - row['q2']
-    std_dev = iqr / 1.349  # Approximation for normal distribution
-    synthetic_data = np.random.normal(mean, std_dev, num_samples)
-    return synthetic_data
+# GRAPH 1: average consumption and production by month
+def figure_p3g1(p3g1):
+    fig = px.line(p3g1, x="Month", y=["Production_MWh", "Consumption_MWh"],
+                  title="Average Energy Consumption and Production by Month",
+                  labels={"value": "Electricity in MWh", "variable": "Legend"})
+    fig.for_each_trace(lambda t: t.update(line=dict(dash='dash')) if t.name == 'Production_MWh' else ())
+    fig.update_layout(width=900, height=500, plot_bgcolor=PLOT_BGCOLOR,
+                      xaxis=dict(**GRID, tickmode="array", tickvals=list(range(1, 13)), ticktext=MONTHS, tickangle=315),
+                      yaxis=dict(**GRID, fixedrange=True), yaxis_range=[0, 5000], yaxis_title="Electricity in MWh")
+    return fig
 
-# Generate synthetic data for each row
-synthetic_data_list = []
+# GRAPH 2: average consumption by hour of the day, one line per season
+def figure_p3g2(p3g2):
+    fig = px.line(p3g2, x="Heure", y="Consumption_MWh", color="Season",
+                  title="Average Energy Consumption by Hour of the Day",
+                  labels={"Consumption_MWh": "Consumption in MWh", "Heure": "Hour of the Day"},
+                  category_orders={"Season": ["Winter", "Spring", "Summer", "Autumn"]},
+                  color_discrete_sequence=["#4C72B0", "#55A868", "#E69F00", "#9C755F"])
+    fig.update_layout(width=900, height=500, plot_bgcolor=PLOT_BGCOLOR,
+                      xaxis=dict(**GRID, tickmode="array", tickvals=list(range(0, 48, 4)), tickangle=315),
+                      yaxis=dict(**GRID, fixedrange=True, range=[0, 3500]), yaxis_title="Electricity in MWh")
+    return fig
 
-for index, row in s3.iterrows():
-    synthetic_values = generate_synthetic_data(row)
-    # Add min and max values
-    synthetic_values = np.append(synthetic_values, [row['min'], row['max']])
-    for value in synthetic_values:
-        synthetic_data_list.append([row['Region'], row['Flow'], value])
+# GRAPH 3 and 4: production stacked by sector, by month in 2022 and by year
+def figure_production(gbmelt, x, title, yaxis_range):
+    fig = px.bar(gbmelt, x=x, y='Production', barmode='stack', color='Sector',
+                 color_discrete_map=SECTOR_COLORS, title=title)
+    fig.update_traces(marker=dict(line=dict(width=0.7)), width=0.6) # Adjust bar width
+    fig.update_layout(width=900, height=500, plot_bgcolor=PLOT_BGCOLOR,
+                      xaxis=GRID, yaxis=dict(**GRID, fixedrange=True), yaxis_range=yaxis_range,
+                      xaxis_title=x, yaxis_title="Production in TWh", legend_title="Energy sources")
+    return fig
+
+def figure_p3g3(p3g3):
+    gbsmelt = p3g3.melt(id_vars='Month', var_name='Sector', value_name='Production')
+    gbsmelt['Month'] = [MONTH_LABELS[month - 1] for month in gbsmelt['Month']]
+    return figure_production(gbsmelt, 'Month', "Monthly production of electricity in 2022, broken down by sector",
+                             [0, 55])
+
+def figure_p3g4(p3g4):
+    gbtmelt = p3g4.melt(id_vars='Year', var_name='Sector', value_name='Production')
+    gbtmelt['Year'] = gbtmelt['Year'].astype(str) # Year as a category, for one bar per year
+    return figure_production(gbtmelt, 'Year', "Yearly production of electricity from 2013 to 2022, broken down by sector",
+                             [0, 550])
+
+# GRAPH 5: distribution of consumption and production by region (whiskers to the extreme values)
+def figure_p3g5(p3g5):
+    fig = px.box(p3g5.assign(Value=p3g5['Value'].round().astype('int32')), x="Region", y="Value", color="Flow",
+                 title="Electricity Consumption and Production by Region",
+                 category_orders={"Region": P3G5_REGION_ORDER},
+                 points=False) # Hide outliers to match whis=(0,100)
+    fig.update_traces(marker=dict(line=dict(width=0.7)), opacity=1)
+    fig.update_layout(width=1000, height=600, plot_bgcolor=PLOT_BGCOLOR, boxmode="group",
+                      xaxis=dict(**GRID, tickangle=315),
+                      yaxis=dict(**GRID, tickformat="d", fixedrange=True,
+                                 zeroline=True, zerolinecolor="black", zerolinewidth=1),
+                      yaxis_range=[-500, 12000], xaxis_title="Region", yaxis_title="Electricity (MWh)",
+                      legend_title="Energy sources")
+    return fig
+
+P3_FIGURE_BUILDERS = {'p3g1': figure_p3g1, 'p3g2': figure_p3g2, 'p3g3': figure_p3g3,
+                      'p3g4': figure_p3g4, 'p3g5': figure_p3g5}
+
+def save_p3_figures(path=P3_FIGURES):
+    figures = {}
+    for name, figure in P3_FIGURE_BUILDERS.items():
+        fig = figure(pd.read_csv(f"{name}.csv", sep = ','))
+        fig.layout.template = None
+        figures[name] = json.loads(pio.to_json(fig, validate=False, remove_uids=True))
+    with open(path, 'w') as f:
+        json.dump(figures, f, separators=(',', ':'))
+
+def build_p3figures(options):
+    save_p3_figures()
+
+NODES = {
+    'p1d1nans': {'sources': [RAW_FILE], 'deps': [], 'outputs': ["p1d1nans.csv"], 'build': build_p1d1nans},
+    'p1nanmasks': {'sources': [RAW_FILE], 'deps': [], 'outputs': [NAN_MASKS], 'build': build_p1nanmasks},
+    'images': {'sources': IMAGE_SOURCES, 'deps': [], 'outputs': [IMAGE_MANIFEST], 'build': build_images},
+    'raw_cache': {'sources': [RAW_FILE], 'deps': [], 'outputs': [os.path.join(CACHE_DIR, 'dfraw2', '_source.json')],
+                  'build': build_raw_cache},
+    'light_cache': {'sources': [LIGHT_FILE], 'deps': [], 'outputs': [os.path.join(CACHE_DIR, 'dfl', '_source.json')],
+                    'build': build_light_cache},
+    'quality': {'sources': [TEMP_FILE], 'deps': ['raw_cache'], 'outputs': QUALITY_OUTPUTS, 'build': build_quality},
+    'features': {'sources': [TEMP_FILE], 'deps': ['raw_cache'], 'outputs': [FEATURES_DIR, UNMATCHED_DATES],
+                 'build': build_temperature_join},
+    'raw_partials': {'sources': [], 'deps': ['raw_cache'], 'outputs': [RAW_PARTIALS, RAW_MONTHS], 'build': build_raw_partials},
+    'light_partials': {'sources': [], 'deps': ['light_cache'],
+                       'outputs': [LIGHT_PARTIALS, SKETCHES_JSON, SKETCHES_NPZ, LIGHT_MONTHS], 'build': build_light_partials},
+    'p3g1': {'sources': [], 'deps': ['raw_partials'], 'outputs': ["p3g1.csv"], 'build': build_p3g1},
+    'p3g2': {'sources': [], 'deps': ['raw_partials'], 'outputs': ["p3g2.csv"], 'build': build_p3g2},
+    'p3g3': {'sources': [], 'deps': ['light_partials'], 'outputs': ["p3g3.csv"], 'build': build_p3g3},
+    'p3g4': {'sources': [], 'deps': ['light_partials'], 'outputs': ["p3g4.csv"], 'build': build_p3g4},
+    'p3g5': {'sources': [], 'deps': ['light_partials'], 'outputs': ["p3g5.csv"], 'build': build_p3g5},
+    'p3figures': {'sources': [], 'deps': list(P3_FIGURE_BUILDERS), 'outputs': [P3_FIGURES], 'build': build_p3figures},
+}
+
+# ETL RUNNER
+# A node is skipped when the hashes of its inputs (sources and outputs of its dependencies) and the code
+# version are the same as at its last successful run, and its outputs exist. Nodes run as soon as their
+# dependencies are done, independent nodes concurrently.
+RUNNER_STATE = os.path.join(PARTIALS_DIR, 'runner.json')
+FULL_REBUILD_NODES = {'raw_partials', 'light_partials'} # always run with --full, whatever their inputs
+
+def node_inputs(name):
+    node = NODES[name]
+    return node['sources'] + [path for dep in node['deps'] for path in NODES[dep]['outputs']]
+
+# Targets and everything they depend on
+def node_closure(targets):
+    names = set()
+    def visit(name):
+        if name not in names:
+            names.add(name)
+            for dep in NODES[name]['deps']:
+                visit(dep)
+    for target in targets:
+        visit(target)
+    return names
 
-# Create a new DataFrame with synthetic data
-s4 = pd.DataFrame(synthetic_data_list, columns=['Region', 'Flow', 'Value'])
+def run_nodes(targets, options):
+    try:
+        with open(RUNNER_STATE) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        state = {}
+    code_version = file_hash(__file__)
+    todo = node_closure(targets)
+    done = set()
+    running = {}
+    with ThreadPoolExecutor(max_workers=len(todo) or 1) as pool:
+        while todo or running:
+            for name in sorted(todo):
+                if all(dep in done for dep in NODES[name]['deps']):
+                    todo.discard(name)
+                    stamp = {'code': code_version, 'inputs': {path: file_hash(path) for path in node_inputs(name)}}
+                    outputs_exist = all(os.path.exists(path) for path in NODES[name]['outputs'])
+                    forced = options.force or (options.full and name in FULL_REBUILD_NODES)
+                    if not forced and outputs_exist and state.get(name) == stamp:
+                        print(f"{name}: up to date")
+                        done.add(name)
+                        continue
+                    print(f"{name}: running")
+                    running[pool.submit(timed, NODES[name]['build'], (options,))] = (name, stamp)
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, stamp = running.pop(future)
+                result, seconds = future.result()
+                timings.append(("node", name, 0, seconds))
+                print(f"{name}: done in {seconds:.1f} s")
+                state[name] = stamp
+                done.add(name)
+                os.makedirs(PARTIALS_DIR, exist_ok=True)
+                with open(RUNNER_STATE, 'w') as f:
+                    json.dump(state, f, indent=1)
 
-s4.shape
+def parse_options(args=None):
+    parser = argparse.ArgumentParser(description="Builds the light datasets of the Streamlit app.")
+    parser.add_argument('targets', nargs='*', metavar='target',
+                        help=f"nodes to build, with their dependencies (default: all of {', '.join(NODES)})")
+    parser.add_argument('--force', action='store_true', help="rebuild the nodes even if they are up to date")
+    parser.add_argument('--full', action='store_true', help="rebuild the page 3 partials from scratch")
+    parser.add_argument('--workers', type=int, default=ETL_WORKERS, help="processes used by the ETL stages")
+    parser.add_argument('--memory-report', action='store_true',
+                        help="print the memory of the raw dataset before and after compaction")
+    options = parser.parse_args(args)
+    unknown = [target for target in options.targets if target not in NODES]
+    if unknown:
+        parser.error(f"unknown target(s) {', '.join(unknown)}, choose from {', '.join(NODES)}")
+    return options
 
-# Check if the distribution matches the initial distribution closely
-# by comparing s5 to s3
-s5 = s4.groupby(['Region', 'Flow'])['Value'].agg(['min', q2, 'mean', q3, 'max'])
-s5 = s5.reset_index()
 
-# If so, we are confident we can export s4 as p3g5 for Streamlit
-s4.to_csv("p3g5.csv", sep=',', index=False)
+if __name__ == "__main__":
+    options = parse_options()
+    if options.memory_report:
+        raw_memory_report()
+    run_nodes(options.targets or list(NODES), options)
+    report_timings()
@@ -0,0 +1,362 @@
+## FAST MODEL ARTIFACT AND INPUT ENCODING FOR THE PREDICTION PAGE
+
+
+# GET STARTED
+
+import numpy as np
+import pandas as pd
+import os
+import json
+import lzma
+import pickle
+import argparse
+import hashlib
+import time
+import threading
+from collections import OrderedDict
+import sklearn
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.tree import DecisionTreeRegressor
+from sklearn.tree._tree import Tree
+
+# MODEL ARTIFACT
+# The Random Forest is stored as uncompressed NumPy arrays, one file per node field with all trees
+# concatenated, plus a small meta.json header. Arrays are memory-mapped when loaded: no lzma decompression
+# and no unpickling of the estimators, only the pages actually read are loaded from disk.
+MODEL_PICKLE = 'model_rf.pkl.xz'
+MODEL_DIR = 'model_rf'
+MODEL_VERSION = 2
+NODE_FIELDS = ['left_child', 'right_child', 'feature', 'threshold', 'impurity',
+               'n_node_samples', 'weighted_n_node_samples', 'missing_go_to_left']
+COMPACT_FIELDS = {'left_child': 'int32', 'right_child': 'int32', 'feature': 'int32', 'n_node_samples': 'int32'}
+
+def load_pickle(path=MODEL_PICKLE):
+    with lzma.open(path, 'rb') as model_file:
+        return pickle.load(model_file)
+
+def export_model(forest, directory=MODEL_DIR):
+    states = [estimator.tree_.__getstate__() for estimator in forest.estimators_]
+    os.makedirs(directory, exist_ok=True)
+    nodes = np.concatenate([state['nodes'] for state in states])
+    for field in NODE_FIELDS:
+        np.save(os.path.join(directory, f"{field}.npy"), nodes[field].astype(COMPACT_FIELDS.get(field, nodes[field].dtype)))
+    values = np.concatenate([state['values'] for state in states])
+    np.save(os.path.join(directory, 'value.npy'), values)
+    # nodes of tree i are offsets[i]:offsets[i + 1]
+    np.save(os.path.join(directory, 'offsets.npy'), np.cumsum([0] + [state['node_count'] for state in states]))
+    np.save(os.path.join(directory, 'depths.npy'), np.array([state['max_depth'] for state in states]))
+    # the model version identifies the trees, so results computed from another model can be told apart
+    digest = hashlib.sha256(nodes)
+    digest.update(values)
+    meta = {'version': MODEL_VERSION, 'model_version': digest.hexdigest()[:12], 'sklearn': sklearn.__version__,
+            'n_estimators': len(states), 'n_nodes': len(nodes), 'n_features': int(forest.n_features_in_),
+            'n_outputs': int(forest.n_outputs_), 'max_features': forest.estimators_[0].max_features_,
+            'params': {key: value for key, value in forest.get_params().items() if key != 'estimator'},
+            'tree_params': {param: getattr(forest, param) for param in forest.estimator_params},
+            'feature_names': list(getattr(forest, 'feature_names_in_', []))}
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    return meta
+
+def read_meta(directory=MODEL_DIR):
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['version'] != MODEL_VERSION:
+        raise ValueError(f"{directory} holds a version {meta['version']} model, expected {MODEL_VERSION}")
+    return meta
+
+# Version of the model, to tell whether results computed from a model are still valid: the one recorded in
+# meta.json at export, or a hash of the pickle content when no artifact was exported (a deployment copies
+# the files with new modification times, so these cannot be used)
+def model_version(directory=MODEL_DIR, pickle_path=MODEL_PICKLE):
+    if os.path.exists(os.path.join(directory, 'meta.json')):
+        return read_meta(directory)['model_version']
+    return pickle_version(pickle_path)
+
+def pickle_version(path=MODEL_PICKLE):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return f"pickle-{digest.hexdigest()[:12]}"
+
+# Memory-mapped arrays of the artifact, by name (node fields, value, offsets, depths)
+def load_arrays(directory=MODEL_DIR):
+    names = NODE_FIELDS + ['value', 'offsets', 'depths']
+    return {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r') for name in names}
+
+# Rebuilds the sklearn RandomForestRegressor from the arrays, tree by tree
+def load_forest(directory=MODEL_DIR):
+    meta, arrays = read_meta(directory), load_arrays(directory)
+    node_dtype = Tree(1, np.ones(1, dtype=np.intp), 1).__getstate__()['nodes'].dtype
+    offsets = arrays['offsets']
+    forest = RandomForestRegressor(**meta['params'])
+    forest.estimator_ = DecisionTreeRegressor(**meta['tree_params'])
+    forest.estimators_ = []
+    for i in range(meta['n_estimators']):
+        start, end = offsets[i], offsets[i + 1]
+        nodes = np.empty(end - start, dtype=node_dtype)
+        for field in NODE_FIELDS:
+            nodes[field] = arrays[field][start:end]
+        tree = Tree(meta['n_features'], np.ones(meta['n_outputs'], dtype=np.intp), meta['n_outputs'])
+        tree.__setstate__({'max_depth': int(arrays['depths'][i]), 'node_count': int(end - start), 'nodes': nodes,
+                           'values': np.ascontiguousarray(arrays['value'][start:end])})
+        estimator = DecisionTreeRegressor(**meta['tree_params'])
+        estimator.tree_, estimator.n_features_in_ = tree, meta['n_features']
+        estimator.n_outputs_, estimator.max_features_ = meta['n_outputs'], meta['max_features']
+        forest.estimators_.append(estimator)
+    forest.n_features_in_, forest.n_outputs_ = meta['n_features'], meta['n_outputs']
+    if meta['feature_names']:
+        forest.feature_names_in_ = np.array(meta['feature_names'], dtype=object)
+    return forest
+
+# FLAT FOREST ENGINE
+# All trees of the forest are walked at once, straight on the memory-mapped arrays of the artifact.
+# For a batch of rows, the current node of every (row, tree) pair sits in one integer array, advanced one
+# level per step with NumPy. Pairs that reach a leaf drop out. X is cast to float32 first, as sklearn does,
+# so comparisons with the float64 thresholds give the same paths.
+# The engine is meant for interactive calls, from one row to a few hundred (about 1 ms for one row, 10x
+# faster than sklearn). Beyond that, the gathers of every level cost more than the compiled traversal of
+# sklearn (about 3x slower on 10k rows), so batch callers must use the sklearn forest (load_forest).
+class FlatForest:
+    def __init__(self, directory=MODEL_DIR):
+        self.meta, arrays = read_meta(directory), load_arrays(directory)
+        self.left, self.right = arrays['left_child'], arrays['right_child'] # local to each tree, -1 for leaves
+        self.feature, self.threshold = arrays['feature'], arrays['threshold']
+        self.missing_go_to_left = arrays['missing_go_to_left']
+        self.value = arrays['value'][:, 0, 0]
+        self.roots = np.asarray(arrays['offsets'][:-1])
+        self.n_features_in_ = self.meta['n_features']
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float32).reshape(-1, self.n_features_in_)
+        n_rows, n_trees = len(X), len(self.roots)
+        base = np.tile(self.roots, n_rows) # root of the tree of each (row, tree) pair
+        row = np.repeat(np.arange(n_rows), n_trees)
+        node = base.copy()
+        active = np.arange(node.size)
+        while active.size:
+            current = node[active]
+            left = self.left[current]
+            inner = left >= 0
+            active, current, left = active[inner], current[inner], left[inner]
+            x = X[row[active], self.feature[current]]
+            go_left = np.where(np.isnan(x), self.missing_go_to_left[current] == 1, x <= self.threshold[current])
+            node[active] = base[active] + np.where(go_left, left, self.right[current])
+        return self.value[node].reshape(n_rows, n_trees).mean(axis=1)
+
+# Largest relative gap between the engine and sklearn on `rows` random inputs
+def check_parity(forest, engine, rows=1000, seed=0, rtol=1e-9):
+    X = np.random.default_rng(seed).random((rows, engine.n_features_in_))
+    expected, predicted = forest.predict(X), engine.predict(X)
+    gap = np.max(np.abs(predicted - expected) / np.maximum(np.abs(expected), np.finfo(float).tiny))
+    if gap > rtol:
+        raise ValueError(f"the flat forest differs from sklearn by up to {gap:.2e} (relative)")
+    return gap
+
+# INPUT ENCODER
+# Encodes the prediction page inputs like prepare_input_data did row by row: one-hot Day_type, Season,
+# Month and Region (first category dropped, Day_type and Season fixed to workday and Summer), MinMax scaling
+# of the numeric features, with the ones that are not inputs set to the middle of their range, Year kept raw,
+# every other feature to 0. Slots and constants are taken from the encoders once, then N rows are filled
+# in one preallocated array.
+CATEGORICAL_COLUMNS = ['Day_type', 'Season', 'Month', 'Region']
+FIXED_INPUTS = {'Day_type': 'workday', 'Season': 'Summer'}
+
+class InputEncoder:
+    def __init__(self, ohe, scaler, feature_ranges, feature_names):
+        position = {name: i for i, name in enumerate(feature_names)}
+        self.n_features = len(feature_names)
+        self.base = np.zeros(self.n_features)
+        # one-hot: categories of each column and the feature slot of each category (-1 when dropped)
+        self.one_hot = {}
+        encoded_names = iter(ohe.get_feature_names_out(CATEGORICAL_COLUMNS))
+        drops = ohe.drop_idx_ if ohe.drop_idx_ is not None else [None] * len(ohe.categories_)
+        for column, categories, drop in zip(CATEGORICAL_COLUMNS, ohe.categories_, drops):
+            slots = np.array([-1 if i == drop else position.get(next(encoded_names), -1)
+                              for i in range(len(categories))])
+            if column in FIXED_INPUTS:
+                slot = slots[list(categories).index(FIXED_INPUTS[column])]
+                if slot >= 0:
+                    self.base[slot] = 1
+            else:
+                self.one_hot[column] = (pd.Index(categories), slots)
+        # numeric: affine constants of the scaler, scaled inputs filled per row, the others folded in the base
+        self.scaled, self.clip = {}, scaler.feature_range if getattr(scaler, 'clip', False) else None
+        for column, scale, offset in zip(feature_ranges, scaler.scale_, scaler.min_):
+            if column not in position:
+                continue
+            if column in ('TAvg', 'Hour_numerical'):
+                self.scaled[column] = (position[column], scale, offset)
+            else:
+                middle = (feature_ranges[column]['min'] + feature_ranges[column]['max']) / 2
+                self.base[position[column]] = self.clipped(middle * scale + offset)
+        self.raw = {'Year': position['Year']} if 'Year' in position else {}
+
+    def clipped(self, values):
+        return values if self.clip is None else np.clip(values, *self.clip)
+
+    # Feature matrix (N, n_features) of the inputs, scalars and arrays broadcast together
+    def transform(self, tavg, year, region, month, hour):
+        inputs = np.broadcast_arrays(*(np.atleast_1d(value) for value in (tavg, year, region, month, hour)))
+        values = dict(zip(['TAvg', 'Year', 'Region', 'Month', 'Hour_numerical'], (value.ravel() for value in inputs)))
+        X = np.tile(self.base, (len(values['TAvg']), 1))
+        for column, (slot, scale, offset) in self.scaled.items():
+            X[:, slot] = self.clipped(values[column] * scale + offset)
+        for column, slot in self.raw.items():
+            X[:, slot] = values[column]
+        for column, (categories, slots) in self.one_hot.items():
+            codes = categories.get_indexer(values[column])
+            if (codes < 0).any():
+                raise ValueError(f"Found unknown {column}: {sorted(map(str, set(values[column][codes < 0])))}")
+            slot = slots[codes]
+            rows = np.flatnonzero(slot >= 0)
+            X[rows, slot[rows]] = 1
+        return X
+
+# BATCH SCORING
+# Scenario files (CSV or Parquet) hold one input combination per row, in the columns below. They are
+# encoded and predicted by chunks of BATCH_ROWS rows, so memory stays bounded and progress can be reported.
+SCENARIO_COLUMNS = ['Region', 'TAvg', 'Year', 'Month', 'Hour']
+PREDICTION_COLUMN = 'Predicted Consumption (MW)'
+BATCH_ROWS = 2048
+
+def read_scenarios(file, name):
+    scenarios = pd.read_parquet(file) if name.lower().endswith('.parquet') else pd.read_csv(file)
+    missing = [column for column in SCENARIO_COLUMNS if column not in scenarios.columns]
+    if missing:
+        raise ValueError(f"Missing scenario columns: {', '.join(missing)}")
+    not_numeric = [column for column in SCENARIO_COLUMNS[1:] if not pd.api.types.is_numeric_dtype(scenarios[column])]
+    if not_numeric:
+        raise ValueError(f"Non-numeric scenario columns: {', '.join(not_numeric)}")
+    return scenarios
+
+# Yields the number of rows scored so far and the predictions of each chunk
+def predict_batches(model, encoder, scenarios, chunk_rows=BATCH_ROWS):
+    for start in range(0, len(scenarios), chunk_rows):
+        chunk = scenarios.iloc[start:start + chunk_rows]
+        X = encoder.transform(tavg=chunk['TAvg'].to_numpy(), year=chunk['Year'].to_numpy(),
+                              region=chunk['Region'].to_numpy(), month=chunk['Month'].to_numpy(),
+                              hour=chunk['Hour'].to_numpy())
+        yield start + len(chunk), model.predict(X)
+
+# PREDICTION CUBE
+# The inputs of the prediction page are discrete, so the whole grid (regions x temperatures x years x months
+# x hours, 2.3M combinations) is scored offline into one float32 array. The app memory-maps it and answers
+# by index lookup, the live model is only needed for inputs outside the grid or when the cube was computed
+# with another model.
+CUBE_DIR = 'prediction_cube'
+CUBE_AXES = {'TAvg': list(range(-15, 41)), 'Year': list(range(2016, 2024)),
+             'Month': list(range(1, 13)), 'Hour': list(range(24))}
+CUBE_INPUTS = {'region': 'Region', 'tavg': 'TAvg', 'year': 'Year', 'month': 'Month', 'hour': 'Hour'} # axis order
+ENCODER_FILES = {'ohe': 'onehotencoder.pkl', 'scaler': 'scaler.pkl',
+                 'feature_ranges': 'feature_min_max.json', 'feature_names': 'feature_names.json'}
+
+def load_encoder(files=ENCODER_FILES):
+    with open(files['ohe'], 'rb') as ohe_file, open(files['scaler'], 'rb') as scaler_file:
+        ohe, scaler = pickle.load(ohe_file), pickle.load(scaler_file)
+    with open(files['feature_ranges']) as ranges_file, open(files['feature_names']) as names_file:
+        return InputEncoder(ohe, scaler, json.load(ranges_file), json.load(names_file))
+
+# Scores the grid one (region, year) block at a time and saves cube.npy with its axes in cube.json
+def score_cube(model, encoder, version, directory=CUBE_DIR):
+    axes = {'Region': [str(region) for region in encoder.one_hot['Region'][0]], **CUBE_AXES}
+    cube = np.empty([len(values) for values in axes.values()], dtype=np.float32)
+    tavg, month, hour = np.meshgrid(axes['TAvg'], axes['Month'], axes['Hour'], indexing='ij')
+    for r, region in enumerate(axes['Region']):
+        start = time.perf_counter()
+        for y, year in enumerate(axes['Year']):
+            X = encoder.transform(tavg.ravel(), year, region, month.ravel(), hour.ravel())
+            cube[r, :, y] = model.predict(X).reshape(tavg.shape)
+        print(f"{region}: {tavg.size * len(axes['Year']):,} predictions in {time.perf_counter() - start:.1f} s")
+    # files are replaced, not rewritten, so a running app keeps its mapping of the previous cube until it
+    # sees the new cube.json
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'cube.npy.tmp'), 'wb') as f:
+        np.save(f, cube)
+    os.replace(os.path.join(directory, 'cube.npy.tmp'), os.path.join(directory, 'cube.npy'))
+    with open(os.path.join(directory, 'cube.json.tmp'), 'w') as f:
+        json.dump({'model_version': version, 'axes': axes}, f, indent=1)
+    os.replace(os.path.join(directory, 'cube.json.tmp'), os.path.join(directory, 'cube.json'))
+    return cube
+
+class PredictionCube:
+    def __init__(self, directory=CUBE_DIR):
+        with open(os.path.join(directory, 'cube.json')) as f:
+            meta = json.load(f)
+        self.model_version, self.axes = meta['model_version'], meta['axes']
+        self.values = np.load(os.path.join(directory, 'cube.npy'), mmap_mode='r')
+        self.index = {column: {value: i for i, value in enumerate(values)} for column, values in self.axes.items()}
+
+    # Index of the inputs in the cube (whole axes for the swept ones), None when one is outside the grid
+    def position(self, inputs, swept=()):
+        position = tuple(slice(None) if name in swept else self.index[column].get(inputs[name])
+                         for name, column in CUBE_INPUTS.items())
+        return None if None in position else position
+
+    # Cube prediction of the inputs, None when one of them is outside the grid
+    def lookup(self, tavg, year, region, month, hour):
+        position = self.position({'tavg': tavg, 'year': year, 'region': region, 'month': month, 'hour': hour})
+        return None if position is None else float(self.values[position])
+
+    # Cube predictions along the whole axes of the swept inputs (e.g. ['region', 'hour'], in the axis order
+    # of the cube), the other inputs fixed
+    def curve(self, swept, **inputs):
+        position = self.position(inputs, list(swept))
+        return None if position is None else np.asarray(self.values[position], dtype=float)
+
+# PREDICTION CACHE
+# Bounded LRU memo of single predictions, shared by all sessions of the app (hence the lock). Keys are the
+# input tuples with the model version, so a new model never serves old values.
+PREDICTION_CACHE_SIZE = 4096
+
+class PredictionCache:
+    def __init__(self, maxsize=PREDICTION_CACHE_SIZE):
+        self.maxsize, self.hits, self.misses = maxsize, 0, 0
+        self.entries, self.lock = OrderedDict(), threading.Lock()
+
+    # Cached value of key, computed (outside the lock) and stored on a miss
+    def get(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+        value = compute()
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'maxsize': self.maxsize}
+
+def parse_options(args=None):
+    parser = argparse.ArgumentParser(description="Converts the Random Forest pickle to the fast model artifact, "
+                                                 "or scores the prediction cube with it (--cube).")
+    parser.add_argument('--pickle', default=MODEL_PICKLE, help="lzma-compressed pickle of the model")
+    parser.add_argument('--output', default=MODEL_DIR, help="directory of the artifact")
+    parser.add_argument('--check', type=int, default=1000, metavar='ROWS',
+                        help="random rows on which the flat forest is compared with sklearn (0 to skip)")
+    parser.add_argument('--cube', action='store_true',
+                        help=f"score the whole input grid into {CUBE_DIR}/ with the model of --output, or the pickle")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    options = parse_options()
+    if options.cube:
+        # sklearn predicts large batches faster than the flat forest
+        exported = os.path.exists(os.path.join(options.output, 'meta.json'))
+        forest = load_forest(options.output) if exported else load_pickle(options.pickle)
+        score_cube(forest, load_encoder(), model_version(options.output, options.pickle))
+        raise SystemExit
+    forest = load_pickle(options.pickle)
+    meta = export_model(forest, options.output)
+    print(f"{options.output}: {meta['n_estimators']} trees, {meta['n_nodes']} nodes")
+    if options.check:
+        gap = check_parity(forest, FlatForest(options.output), options.check)
+        print(f"flat forest matches sklearn on {options.check} rows (largest relative gap {gap:.1e})")
@@ -14,7 +14,9 @@ import io
 import lzma  # ADDITION: required to read .xz compressed files
 import pickle
 import json
-from PIL import Image
+import os
+import time
+import Light_prediction
 
 # LAYOUT AND SIDEBAR
 
@@ -67,13 +69,68 @@ st.sidebar.markdown(
 
 # LOADING LIGHTER DATASETS
 # Naming convention: p3g1 means page 3 graph 1
-
-p1d1nans = pd.read_csv('p1d1nans.csv', sep = ',')
-p3g1 = pd.read_csv('p3g1.csv', sep = ',')
-p3g2 = pd.read_csv('p3g2.csv', sep = ',')
-p3g3 = pd.read_csv('p3g3.csv', sep = ',')
-p3g4 = pd.read_csv('p3g4.csv', sep = ',')
-p3g5 = pd.read_csv('p3g5.csv', sep = ',')
+# Each page loads only its own datasets. Parsed datasets are shared by all sessions (st.cache_data)
+# and keyed on the file size and modification time, so a file rebuilt by the ETL is read again.
+def file_version(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+@st.cache_data(show_spinner=False)
+def read_dataset(path, version):
+    return pd.read_csv(path, sep = ',')
+
+def load_dataset(name):
+    path = f"{name}.csv"
+    return read_dataset(path, file_version(path))
+
+# Ready-to-render Plotly figures of page 3 (built by Light_datasets_creation.py p3figures)
+@st.cache_data(show_spinner=False)
+def read_figures(path, version):
+    with open(path) as f:
+        return json.load(f)
+
+def load_figures(path='p3figures.json'):
+    return read_figures(path, file_version(path))
+
+# Images converted by Light_datasets_creation.py images: WebP / AVIF at display width, served from static/
+@st.cache_data(show_spinner=False)
+def read_image_manifest(path, version):
+    with open(path) as f:
+        return json.load(f)
+
+def image_manifest(path='static/images.json'):
+    if not os.path.exists(path):
+        return {}
+    return read_image_manifest(path, file_version(path))
+
+# The browser picks the AVIF variant if it supports it, the WebP one otherwise (the PNG if no variant was built)
+def show_image(name, width=800, caption=None):
+    variants = image_manifest().get(name)
+    if variants is None:
+        st.image(name, width=width, caption=caption)
+        return
+    avif = f'<source srcset="app/static/{variants["avif"]}" type="image/avif">' if 'avif' in variants else ''
+    size = 'width:100%' if width == 'stretch' else f'width:{width}px; max-width:100%'
+    st.markdown(f'<picture>{avif}<img src="app/static/{variants["webp"]}" alt="{caption or name}" style="{size}"></picture>',
+                unsafe_allow_html=True)
+    if caption:
+        st.caption(caption)
+
+# Tabs that only build the selected section, where st.tabs builds every tab on each rerun
+def lazy_tabs(labels, key):
+    return st.segmented_control(key, labels, default=labels[0], key=key, label_visibility="collapsed") or labels[0]
+
+# Bit-packed NaN masks of the raw dataset, per year (built by Light_datasets_creation.py p1nanmasks)
+@st.cache_data(show_spinner=False)
+def read_nan_masks(path, version):
+    masks = np.load(path)
+    bins = int(masks['bins'])
+    return masks['years'], list(masks['columns']), np.unpackbits(masks['masks'], axis=1, count=bins), bins
+
+def load_nan_masks(path='p1nanmasks.npz'):
+    if not os.path.exists(path):
+        return None
+    return read_nan_masks(path, file_version(path))
 
 
 # PAGE 0 # INTRODUCTION
@@ -100,6 +157,8 @@ if page == pages[0] :
 
 # PAGE 1 # Exploration and clearning
 if page == pages[1] :
+    p1d1nans = load_dataset('p1d1nans')
+    p1nanmasks = load_nan_masks()
     st.title("Data exploration and cleaning")
 
     # EXPLORATION
@@ -170,28 +229,48 @@ if page == pages[1] :
     with st.expander("**Number of Missing Values by Variable**"):
         st.dataframe(p1d1nans)
 
+    # Heatmap of the missing values for a range of years: one row per variable, one block of row bins per year.
+    # The masks need the raw dataset, until they are built the screenshot of the same years is shown
+    def nan_heatmap(first_year, last_year, screenshot):
+        if p1nanmasks is None:
+            show_image(screenshot, width=800)
+            return
+        years, columns, masks, bins = p1nanmasks
+        selected = (years >= first_year) & (years <= last_year)
+        if not selected.any():
+            st.info(f"No rows between {first_year} and {last_year} in the dataset.")
+            return
+        z = np.concatenate(masks[selected], axis=0).T
+        fig = px.imshow(z, y=columns, aspect='auto', zmin=0, zmax=1,
+                        color_continuous_scale=[[0, '#03051A'], [1, '#FAEBDD']])
+        fig.update_xaxes(tickvals=[i * bins for i in range(selected.sum())], ticktext=[str(y) for y in years[selected]])
+        fig.update_yaxes(tickmode='array', tickvals=list(range(len(columns))), ticktext=columns)
+        fig.update_layout(height=700, width=800, coloraxis_showscale=False, margin=dict(l=0, r=0, t=20, b=0))
+        fig.update_traces(hovertemplate='%{y}<extra></extra>')
+        st.plotly_chart(fig)
+
     with st.expander("**Visualizing Missing Values with a heatmap**"):
         st.write("As seen in the optional modules dedicated to data quality and to plotly, we leveraged the heatmap representation to better understand the distribution of missing values. ")
         
-        tab1, tab2, tab3 = st.tabs(["2013-2019", "2020", "2021-2022"])
+        tab = lazy_tabs(["2013-2019", "2020", "2021-2022"], "p1_heatmaps")
         
-        with tab1:
+        if tab == "2013-2019":
             st.subheader("Every years from 2013 to 2019 share a comparable profile")
             st.warning("Missing values are displayed in light pink. We note the absence of TCO and TCH indicators that enable comparisons of energy production sectors among region. They were introduced from 2020 only.", 
                        icon=":material/percent:")
-            st.image("heatmap_nans_1.png", width=800)
+            nan_heatmap(2013, 2019, "heatmap_nans_1.png")
 
-        with tab2:
+        if tab == "2020":
             st.subheader("2020 has less missing values")
             st.warning("We found why Nuclear production had missing values in 33% of the rows. They correspond to regions without any nuclear facility.", 
                        icon=":material/map_search:")
-            st.image("heatmap_nans_2.png", width=800)
+            nan_heatmap(2020, 2020, "heatmap_nans_2.png")
 
-        with tab3:
+        if tab == "2021-2022":
             st.subheader("From 2021 nuclear production is set to zero in the 5 nuclear-free regions")
             st.warning("The remaining missing values reflect the impossibility to compute the Charge Rate (TCH) of nuclear production in nuclear-free regions.", 
                        icon=":material/percent:")
-            st.image("heatmap_nans_3.png", width=800)
+            nan_heatmap(2021, 2022, "heatmap_nans_3.png")
 
     # Temperature dataset 
     st.subheader("Regional daily temperature (Weathernews France)")
@@ -235,17 +314,17 @@ if page == pages[1] :
     # CLEANING
     st.header("Data merging and cleaning")
 
-    tab1, tab2, tab3, tab4, tab5 = st.tabs(["Start", "Structure", "Variable classes", "Missing values", "Quality check"])
-    with tab1:
-        st.image("Image1.png", width=800) 
-    with tab2:
-        st.image("Image2.png", width=800)         
-    with tab3:
-        st.image("Image3.png", width=800)         
-    with tab4:
-        st.image("Image4.png", width=800)          
-    with tab5:
-        st.image("Image5.png", width=800) 
+    tab = lazy_tabs(["Start", "Structure", "Variable classes", "Missing values", "Quality check"], "p1_cleaning")
+    if tab == "Start":
+        show_image("Image1.png")
+    if tab == "Structure":
+        show_image("Image2.png")
+    if tab == "Variable classes":
+        show_image("Image3.png")
+    if tab == "Missing values":
+        show_image("Image4.png")
+    if tab == "Quality check":
+        show_image("Image5.png")
 
     st.warning("Only the main dataset needs cleaning at this stage.", 
             icon=":material/info:")
@@ -259,207 +338,65 @@ if page == pages[2] :
     # FEATURE ENGINEERING #
     st.subheader("Feature engineering")    
 
-    tab1, tab2, tab3, tab4 = st.tabs(["Feature creation", "Transformation", "Encoding and feature selection", "Normalisation"])
-    with tab1:
-        st.image("feature_1.png", width=800) 
-    with tab2:
-        st.image("feature_2.png", width=800)         
-    with tab3:
-        st.image("feature_3.png", width=800)         
-    with tab4:
-        st.image("feature_4.png", width=800)          
+    tab = lazy_tabs(["Feature creation", "Transformation", "Encoding and feature selection", "Normalisation"], "p2_features")
+    if tab == "Feature creation":
+        show_image("feature_1.png")
+    if tab == "Transformation":
+        show_image("feature_2.png")
+    if tab == "Encoding and feature selection":
+        show_image("feature_3.png")
+    if tab == "Normalisation":
+        show_image("feature_4.png")
 
     # STATISTICAL TESTS ON FEATURES
     st.subheader("Statistical tests on features") 
 
-    tab5, tab6, tab7, tab8 = st.tabs(["Correlation matrix I", "Correlation matrix II", "Correlation matrix III", "Histograms and QQ-plots"])
-    with tab5:
+    tab = lazy_tabs(["Correlation matrix I", "Correlation matrix II", "Correlation matrix III", "Histograms and QQ-plots"], "p2_tests")
+    if tab == "Correlation matrix I":
         st.warning("This heatmap has label encoded regions. It does not include the seasons and the encoded months, in order to ensure legibility.",
                    icon=":material/apps:")
-        st.image("Tests_1.png", width=800) 
-    with tab6:
+        show_image("Tests_1.png")
+    if tab == "Correlation matrix II":
         st.warning("Now we focus on the encoded seasons and the encoded months.",
                    icon=":material/apps:")
-        st.image("Tests_2.png", width=800)         
-    with tab7:
+        show_image("Tests_2.png")
+    if tab == "Correlation matrix III":
         st.warning("This heatmap has one hot encoded regions.",
                    icon=":material/apps:")
-        st.image("Tests_3.png", width=800)         
-    with tab8:
+        show_image("Tests_3.png")
+    if tab == "Histograms and QQ-plots":
         st.success("Following the Shapiro-Willcox test, the numerical temperature-related values are not normally distributed.",
                    icon=":material/search_insights:")
-        st.image("Tests_4.png", width=800)
+        show_image("Tests_4.png")
 
 
 # PAGE 3 # DATAVISUZALIZATION
 if page == pages[3] :
+    p3figures = load_figures()
     st.title("Visualization")
 
     # GRAPH 1 #
     st.subheader("Seasonality is key to balance production and consumption")
-    
-    # gbraw= dfraw2.groupby('Month', as_index = False)[['Consumption_MWh', 'Production_MWh']].mean().round()
-    # we replace gbraw by p3g1
-    fig = px.line(p3g1, 
-                  x = "Month", 
-                  y = ["Production_MWh", "Consumption_MWh"], 
-                  title = "Average Energy Consumption and Production by Month",
-                  labels={"value": "Electricity in MWh", "variable": "Legend"})
-    fig.for_each_trace(lambda t: t.update(line=dict(dash='dash')) if t.name == 'Production_MWh' else ())
-
-    fig.update_layout( 
-        width = 900, height = 500,
-        plot_bgcolor="rgba(240, 242, 246, 0.8)",
-        xaxis= dict( 
-            showgrid=True, gridcolor="gray", gridwidth=1, griddash="dot",
-            tickmode="array", tickvals=list(range(1, 13)),
-            ticktext=['January', 'February', 'March', 'April', 'May', 'June', 'July', 
-                      'August', 'September', 'October', 'November', 'December'],
-            tickangle=315),
-        yaxis=dict(showgrid=True, gridcolor="gray", gridwidth=1, griddash="dot", fixedrange=True),
-        yaxis_range=[0, 5000],
-        yaxis_title="Electricity in MWh"
-        )
-    
-    st.plotly_chart(fig)
+    st.plotly_chart(p3figures['p3g1'])
 
     # GRAPH 2 #  
     st.subheader("Demand also varies over the day")
-    
-    # gb2raw= dfraw2.groupby(['Heure', 'Season'], as_index = False)[['Consumption_MWh']].mean().round()
-    # we replace gbraw by p3g2
-    fig = px.line(p3g2, 
-                  x = "Heure", 
-                  y = "Consumption_MWh", 
-                  color = "Season",
-                  title = "Average Energy Consumption by Hour of the Day",
-                  labels={"Consumption_MWh": "Consumption in MWh", "Heure": "Hour of the Day"},
-                  category_orders={"Season": ["Winter", "Spring", "Summer", "Autumn"]}, 
-                  color_discrete_sequence = ["#4C72B0", "#55A868", "#E69F00", "#9C755F"]) 
-
-    fig.update_layout( 
-        width = 900, height = 500,
-        plot_bgcolor="rgba(240, 242, 246, 0.8)",
-        xaxis= dict( 
-            showgrid=True, gridcolor="gray", gridwidth=1, griddash="dot",
-            tickmode="array", tickvals=list(range(0, 48, 4)), tickangle = 315,
-        ),
-        yaxis=dict(showgrid=True, gridcolor="gray", gridwidth=1, griddash="dot", 
-                   fixedrange=True, range=[0, 3500]),
-        yaxis_title="Electricity in MWh"
-    )
-
-    st.plotly_chart(fig)
+    st.plotly_chart(p3figures['p3g2'])
 
     # GRAPH 3 # Monthly production broken down by sector in 2022
     st.subheader("The French electric mix relies on nuclear power")
-
-    # Create gbs (groupby "small") With groupby (by Month) and melt it by month/sector
-    # dfl_2022 = dfl[dfl['Year'] == 2022]
-    # gbs = dfl_2022.groupby('Month')[['Nuclear', 'Hydro', 'Wind', 'Solar', 'Bioenergy', 'Thermal']].sum().mul(0.5).div(1000000).round(1)
-    # we replace gbs by p3g3
-    gbsmelt = p3g3.melt(id_vars='Month', var_name='Sector', value_name='Production')
-
-    color_map = { 
-        'Nuclear': '#5603AD',
-        'Hydro': '#1E96FC',
-        'Wind': '#5DD39E',
-        'Solar': '#FFD333',
-        'Bioenergy': '#FE938C',
-        'Thermal': '#27313F'
-         }
-    
-    month_labels = ['Jan.', 'Feb.', 'March', 'April', 'May', 'June', 
-                    'July', 'Aug.', 'Sept.', 'Oct.', 'Nov.', 'Dec.']
-
-    gbsmelt['Month'] = gbsmelt['Month'].map(lambda x: month_labels[x-1]) # Use map on the 'Month' column of gbsmelt and substract 1 to match the index in the month_labels
-
-    fig = px.bar(gbsmelt, x = 'Month', y = 'Production', barmode='stack', 
-                 color='Sector', color_discrete_map=color_map, 
-                 title="Monthly production of electricity in 2022, broken down by sector")
-    fig.update_traces(marker=dict(line=dict(width=0.7)), width=0.6)  # Adjust bar width
-    fig.update_layout( 
-        width=900, height=500,
-        plot_bgcolor="rgba(240, 242, 246, 0.8)",
-        xaxis=dict(showgrid=True, gridcolor="gray", gridwidth=1, griddash="dot"),
-        yaxis=dict(showgrid=True, gridcolor="gray", gridwidth=1, griddash="dot", fixedrange=True),
-        yaxis_range=[0, 55],
-        xaxis_title="Month",
-        yaxis_title="Production in TWh",
-        legend_title="Energy sources"
-        )
-    st.plotly_chart(fig)
+    st.plotly_chart(p3figures['p3g3'])
 
     # GRAPH 4 # Yearly production of electricity from 2013 to 2022, broken down by sector
     st.subheader ("2013-2022: Variations among years are multifactorial")
-    
-    # Create gbt (groupby "tall") With groupby (by Year) and melt it by year/sector
-    # gbt = dfl.groupby('Year')[ 
-    #    ['Nuclear', 'Hydro', 'Wind', 'Solar', 'Bioenergy', 'Thermal'] 
-    #    ].sum().mul(0.5).div(1000000).round() # replacing * 0.5 / 1000000
-    # we replace gbt by p3g4
-    gbtmelt = p3g4.melt(id_vars='Year', var_name='Sector', value_name='Production')
-
-    # Ensure Year is categorical and ordered for correct display
-    gbtmelt['Year'] = gbtmelt['Year'].astype(str)
-
-    # Create bar plot
-    fig = px.bar(gbtmelt, x = 'Year', y = 'Production', barmode='stack', 
-                 color='Sector', color_discrete_map=color_map, 
-                 title="Yearly production of electricity from 2013 to 2022, broken down by sector")
-    fig.update_traces(marker=dict(line=dict(width=0.7)), width=0.6)  # Adjust bar width
-    fig.update_layout( 
-        width=900, height=500,
-        plot_bgcolor="rgba(240, 242, 246, 0.8)",
-        xaxis=dict(showgrid=True, gridcolor="gray", gridwidth=1, griddash="dot"),
-        yaxis=dict(showgrid=True, gridcolor="gray", gridwidth=1, griddash="dot", fixedrange=True),
-        yaxis_range=[0, 550],
-        xaxis_title="Year",
-        yaxis_title="Production in TWh",
-        legend_title="Energy sources"
-        )
-    st.plotly_chart(fig)    
+    st.plotly_chart(p3figures['p3g4'])
 
     # GRAPH 5 # Electricity consumption and production by region (distribution)
     st.subheader("French regions are structurally interdependent")
     st.text("Electricity generation facilities are not evenly distributed across the regions.")
     st.info("To make the data easier to read, the whisker boxes extend to the extreme values.", 
             icon=":material/info:")
-    
-    # we replace dfl_melted by p3g5 
-    #    dfl_melted = pd.melt(dfl, id_vars="Region",
-    #                     value_vars=['ConsumptionMWh', "ProductionMWh"],
-    #                     var_name="Type", value_name="Value")    
-    fig = px.box(p3g5,
-                 x="Region",
-                 y="Value",
-                 color="Flow",
-                 title="Electricity Consumption and Production by Region",
-                 category_orders={"Region": ["Auvergne-Rhone-Alpes", "Grand Est", "Centre-Val de Loire",
-                                             "Normandie", "Nouvelle-Aquitaine", "Hauts-de-France", 
-                                             "Occitanie", "Provence-Alpes-Cote d'Azur", "Pays de la Loire", 
-                                             "Bretagne", "Bourgogne-Franche-Comte", "Ile-de-France"]
-                                             },
-                 points=False,  # Hide outliers to match whis=(0,100)
-                 )
-    fig.update_traces(marker=dict(line=dict(width=0.7)),opacity=1)
-    fig.update_layout( 
-        width=1000, height=600,
-        plot_bgcolor="rgba(240, 242, 246, 0.8)",
-        boxmode="group",  # Equivalent to Seaborn's hue differentiation
-        xaxis=dict(
-        showgrid=True, gridcolor="gray", gridwidth=1, griddash="dot", tickangle=315
-        ),
-        yaxis=dict(
-            tickformat="d", showgrid=True, gridcolor="gray", gridwidth=1, griddash="dot", fixedrange=True,
-            zeroline=True, zerolinecolor="black", zerolinewidth=1  # Apply zeroline to y-axis
-        ),
-        yaxis_range=[-500, 12000],
-        xaxis_title="Region",
-        yaxis_title="Electricity (MWh)",
-        legend_title="Energy sources"
-        )
-    st.plotly_chart(fig)
+    st.plotly_chart(p3figures['p3g5'])
 
     st.warning("Please note: in order to simplify the application for publication, we have generated a limited set of synthetic data based on the centrality and dispersion values for each region.", 
         icon=":material/info:")
@@ -474,9 +411,9 @@ if page == pages[4]:
     st.write("")
     
     # Create Tabs
-    tab1, tab2, tab3 = st.tabs(["Model Pre-selection", "Detailed Model Results", "Performance Indicators"])
+    tab = lazy_tabs(["Model Pre-selection", "Detailed Model Results", "Performance Indicators"], "p4_models")
 
-    with tab1:
+    if tab == "Model Pre-selection":
         st.subheader("Model Pre-selection")
         preselection_data = {
             "Model": ["Linear Regression", "Decision Tree Regressor (Tree)", "Random Forest Regressor (Tree)", "Lasso (linear)", "LassoCV (linear)", "Ridge (linear)"],
@@ -495,7 +432,7 @@ if page == pages[4]:
         preselection_df = pd.DataFrame(preselection_data)
         st.dataframe(preselection_df)
 
-    with tab2:
+    if tab == "Detailed Model Results":
         st.subheader("Detailed Model Results")
         data = {
             "Model": [
@@ -530,10 +467,9 @@ if page == pages[4]:
             icon=":material/compare_arrows:"
         )
 
-    with tab3:
+    if tab == "Performance Indicators":
         st.subheader("Performance Indicators")
-        image = Image.open("Performace_RandomForrest.png")
-        st.image(image, caption="Performance Model Indicators", use_container_width=True)
+        show_image("Performace_RandomForrest.png", width='stretch', caption="Performance Model Indicators")
         st.info(
             "The model performance indicators of the QQ Plot indicate deviations from normality within the tails, even after improving the hyperparameters of the Random Forest (number of trees, maximum depth, minimum samples per leaf).",
             icon=":material/info:"
@@ -542,13 +478,25 @@ if page == pages[4]:
 # PAGE 5 # PREDICTION
 if page == pages[5]:
 
-    @st.cache_resource
-    def load_model():
+    # The model is loaded on the first prediction. When model_rf/ was exported (python Light_prediction.py),
+    # predictions run on the flat forest engine, straight on its memory-mapped arrays, from the compressed
+    # pickle otherwise. Models are keyed on their version, so a new export is picked up without a restart
+    @st.cache_resource(max_entries=1)
+    def load_model(version):
+        if os.path.exists(os.path.join(Light_prediction.MODEL_DIR, 'meta.json')):
+            return Light_prediction.FlatForest()
         # with open('model_rf.pkl', 'rb') as model_file:
         with lzma.open('model_rf.pkl.xz', 'rb') as model_file:  # MODIFICATION: open compressed .xz file
             model = pickle.load(model_file)
         return model
 
+    # Uploaded scenarios are scored with the sklearn forest, faster than the flat forest engine on batches
+    @st.cache_resource(max_entries=1)
+    def load_batch_model(version):
+        if os.path.exists(os.path.join(Light_prediction.MODEL_DIR, 'meta.json')):
+            return Light_prediction.load_forest()
+        return load_model(version)
+
     @st.cache_resource
     def load_scaler():
         with open('scaler.pkl', 'rb') as scaler_file:
@@ -573,12 +521,50 @@ if page == pages[5]:
             original_features = json.load(json_file)
         return original_features
 
-    # Load model, scaler, and one hot encoder
-    model = load_model()
-    scaler = load_scaler()
-    ohe = load_ohe()
-    feature_ranges = load_feature_ranges()
-    original_features = load_original_features()
+    # Version of the model (from meta.json, or a hash of the pickle), None when no model is shipped. It is read
+    # once per server for each version of the model files, so the pickle is not hashed again on every run.
+    @st.cache_resource(max_entries=1)
+    def read_model_version(versions):
+        return Light_prediction.model_version()
+
+    def current_model_version():
+        paths = [os.path.join(Light_prediction.MODEL_DIR, 'meta.json'), Light_prediction.MODEL_PICKLE]
+        try:
+            return read_model_version(tuple(file_version(path) if os.path.exists(path) else None for path in paths))
+        except FileNotFoundError:
+            return None
+
+    # The prediction cube (python Light_prediction.py --cube) answers the inputs of its grid by index lookup.
+    # It is keyed on the size and modification time of cube.json, like the datasets, and only used when it
+    # was scored with the current model, or when no model is shipped
+    @st.cache_resource(max_entries=1)
+    def read_cube(version):
+        return Light_prediction.PredictionCube()
+
+    def load_cube(model_version):
+        path = os.path.join(Light_prediction.CUBE_DIR, 'cube.json')
+        if not os.path.exists(path):
+            return None
+        cube = read_cube(file_version(path))
+        return cube if model_version in (None, cube.model_version) else None
+
+    # Predictions already made in any session, evicted least recently used first beyond PREDICTION_CACHE_SIZE
+    # entries (environment variable)
+    @st.cache_resource
+    def load_prediction_cache():
+        return Light_prediction.PredictionCache(int(os.environ.get('PREDICTION_CACHE_SIZE', Light_prediction.PREDICTION_CACHE_SIZE)))
+
+    # The inputs are encoded with the slots and constants of the one hot encoder, the scaler and the feature
+    # lists, compiled once per server
+    @st.cache_resource
+    def load_encoder():
+        return Light_prediction.InputEncoder(load_ohe(), load_scaler(), load_feature_ranges(), load_original_features())
+
+    # Load the input encoder and the prediction cube (the model is loaded on the first prediction outside the cube)
+    encoder = load_encoder()
+    model_version = current_model_version()
+    cube = load_cube(model_version)
+    prediction_cache = load_prediction_cache()
 
     # Streamlit UI
     st.title("Energy Consumption Prediction")
@@ -597,44 +583,129 @@ if page == pages[5]:
     month = st.slider("Month", 1, 12, 6)
     hour = st.slider("Time of Day", 0, 23, 12)
 
-    # Prepare input data
+    # Prepare input data (Day_type and Season are fixed to workday and Summer, see InputEncoder)
     def prepare_input_data(tavg, year, region, month, hour):
-        input_df = pd.DataFrame({
-            "TAvg": [tavg],
-            "Year": [year],
-            "Month": [month],
-            "Hour_numerical": [hour],
-            "Region": [region],
-            "Day_type": ["workday"],
-            "Season": ["Summer"],
-        })
+        return encoder.transform(tavg, year, region, month, hour)
 
-        categorical_cols = ["Day_type", "Season", "Month", "Region"]
-        input_encoded = pd.DataFrame(ohe.transform(input_df[categorical_cols]), columns=ohe.get_feature_names_out(categorical_cols))
-        input_df = pd.concat([input_df.drop(columns=categorical_cols), input_encoded], axis=1)
-
-        numeric_cols = list(feature_ranges.keys())
-        missing_cols = [col for col in numeric_cols if col not in input_df.columns]
-        for col in missing_cols:
-            input_df[col] = (feature_ranges[col]['min'] + feature_ranges[col]['max']) / 2
-
-        input_df[numeric_cols] = scaler.transform(input_df[numeric_cols])
-
-        input_list = [input_df[feature].values[0] if feature in input_df.columns else 0 for feature in original_features]
-
-        return np.array([input_list])
+    # Predict energy consumption: from the cache, then the cube, then the model
+    def predict_consumption(tavg, year, region, month, hour):
+        prediction = cube.lookup(tavg, year, region, month, hour) if cube is not None else None
+        if prediction is None:
+            model = load_model(model_version)
+            input_data = prepare_input_data(tavg, year, region, month, hour)
+            prediction = float(model.predict(input_data)[0])
+        return prediction
 
-    # Predict energy consumption
     if st.button("Predict Consumption"):
         with st.spinner('Predicting Energy Consumption...'):
-            input_data = prepare_input_data(tavg, year, region, month, hour)
-            prediction = model.predict(input_data)[0]
+            key = (region, tavg, year, month, hour, model_version)
+            prediction = prediction_cache.get(key, lambda: predict_consumption(tavg, year, region, month, hour))
         st.markdown(f"<h3>Predicted Consumption: {prediction:.4f} MW</h3>", unsafe_allow_html=True)
+        cache_stats = prediction_cache.stats()
+        st.caption(f"Prediction cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                   f"{cache_stats['size']} / {cache_stats['maxsize']} entries")
+
+    # What-if curves: the hourly profile of the selected day and the consumption over the temperature range,
+    # each from one cube slice or one batched prediction. The hourly profile is compared with the average
+    # profile of the season of the selected month (page 3 graph 2, in MWh per half hour, so doubled to MW)
+    # Predictions over the grid of the swept inputs ({name: values}, in the axis order of the cube)
+    def predict_curve(sweeps, **inputs):
+        curve = cube.curve(sweeps, **inputs) if cube is not None else None
+        if curve is None:
+            grids = dict(zip(sweeps, np.meshgrid(*sweeps.values(), indexing='ij')))
+            X = encoder.transform(**{**inputs, **grids})
+            curve = load_model(model_version).predict(X).reshape(next(iter(grids.values())).shape)
+        return curve
+
+    def what_if_curves():
+        inputs = {'tavg': tavg, 'year': year, 'region': region, 'month': month, 'hour': hour}
+        hours, temperatures = Light_prediction.CUBE_AXES['Hour'], Light_prediction.CUBE_AXES['TAvg']
+        season = ['Winter', 'Spring', 'Summer', 'Autumn'][month % 12 // 3]
+        p3g2 = load_dataset('p3g2')
+        profile = p3g2[p3g2['Season'] == season]
+        profile_hours = [int(time[:2]) + int(time[3:]) / 60 for time in profile['Heure']]
+
+        fig = px.line(x=hours, y=predict_curve({'hour': hours}, **inputs), markers=True,
+                      title=f"Predicted Consumption by Hour in {region}, {tavg} °C, {month}/{year}",
+                      labels={'x': "Hour of the Day", 'y': "Consumption in MW"})
+        fig.data[0].name, fig.data[0].showlegend = "Prediction", True
+        fig.add_scatter(x=profile_hours, y=2 * profile['Consumption_MWh'], mode='lines', line=dict(dash='dot'),
+                        name=f"{season} average (all regions)")
+        fig.update_layout(width=900, height=450, yaxis=dict(rangemode='tozero'))
+        st.plotly_chart(fig)
+
+        fig = px.line(x=temperatures, y=predict_curve({'tavg': temperatures}, **inputs), markers=True,
+                      title=f"Predicted Consumption by Average Temperature in {region}, {hour}h, {month}/{year}",
+                      labels={'x': "Average Temperature of the Day (°C)", 'y': "Consumption in MW"})
+        fig.update_layout(width=900, height=450, yaxis=dict(rangemode='tozero'))
+        st.plotly_chart(fig)
+
+    st.subheader("What-if Curves")
+    if st.toggle("Show the hourly and temperature curves of the selected inputs"):
+        what_if_curves()
+
+    # National forecast: the 12 regions are predicted together, at the selected hour and over the whole day
+    # (12 x 24 rows), with the same temperature for every region
+    def national_forecast():
+        inputs = {'tavg': tavg, 'year': year, 'month': month, 'hour': hour}
+        national_regions, hours = sorted(regions), Light_prediction.CUBE_AXES['Hour']
+        start = time.perf_counter()
+        by_region = predict_curve({'region': national_regions}, **inputs)
+        regions_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        day = predict_curve({'region': national_regions, 'hour': hours}, **inputs)
+        day_seconds = time.perf_counter() - start
+
+        st.markdown(f"<h3>Predicted National Consumption: {by_region.sum():,.0f} MW</h3>", unsafe_allow_html=True)
+        st.caption(f"{len(national_regions)} regions in {regions_seconds * 1000:.1f} ms, "
+                   f"day profile ({day.size} rows) in {day_seconds * 1000:.1f} ms")
+        breakdown = pd.DataFrame({'Region': national_regions, 'Consumption (MW)': by_region})
+        fig = px.bar(breakdown.sort_values('Consumption (MW)'), x='Consumption (MW)', y='Region', orientation='h',
+                     title=f"Predicted Consumption by Region, {tavg} °C, {hour}h, {month}/{year}")
+        fig.update_layout(width=900, height=450)
+        st.plotly_chart(fig)
+        profile = pd.DataFrame({'Region': np.repeat(national_regions, len(hours)), 'Hour': np.tile(hours, len(national_regions)),
+                                'Consumption (MW)': day.ravel()})
+        fig = px.area(profile, x='Hour', y='Consumption (MW)', color='Region',
+                      title=f"Predicted National Consumption by Hour, {tavg} °C, {month}/{year}")
+        fig.update_layout(width=900, height=500)
+        st.plotly_chart(fig)
+
+    st.subheader("National Forecast")
+    if st.button("Predict National Consumption"):
+        with st.spinner('Predicting National Consumption...'):
+            national_forecast()
+
+    # Batch scenarios: an uploaded file is scored by chunks, the results are kept in the session for the download
+    st.subheader("Batch Scenarios")
+    st.write(f"Upload a CSV or Parquet file with one scenario per row and the columns "
+             f"{', '.join(Light_prediction.SCENARIO_COLUMNS)} (regions written as in the list above).")
+    scenario_file = st.file_uploader("Scenarios", type=['csv', 'parquet'])
+    if scenario_file is not None and st.button("Score Scenarios"):
+        try:
+            scenarios = Light_prediction.read_scenarios(scenario_file, scenario_file.name)
+            model = load_batch_model(model_version)
+            progress = st.progress(0.0, text="Scoring scenarios...")
+            predictions = [np.empty(0)]
+            start = time.perf_counter()
+            for done, chunk in Light_prediction.predict_batches(model, encoder, scenarios):
+                predictions.append(chunk)
+                progress.progress(done / len(scenarios), text=f"{done:,} / {len(scenarios):,} scenarios")
+            seconds = time.perf_counter() - start
+        except ValueError as error:
+            st.error(f"The scenarios could not be scored: {error}")
+        else:
+            scored = scenarios.assign(**{Light_prediction.PREDICTION_COLUMN: np.concatenate(predictions)})
+            st.session_state['batch_scores'] = (os.path.splitext(scenario_file.name)[0] + '_predictions.csv',
+                                                scored.to_csv(index=False), len(scored), seconds)
+    if 'batch_scores' in st.session_state:
+        file_name, results, rows, seconds = st.session_state['batch_scores']
+        st.caption(f"{rows:,} scenarios scored in {seconds:.2f} s ({rows / max(seconds, 1e-9):,.0f} rows/s)")
+        st.download_button("Download Predictions", results, file_name=file_name, mime='text/csv', on_click='ignore')
 
     # Always display feature importance graph below the prediction button
     def feature_importance_graph():
-        image = Image.open("feature_importance.png")
-        st.image(image, caption="Feature Importance", use_container_width=True)
+        show_image("feature_importance.png", width='stretch', caption="Feature Importance")
 
     feature_importance_graph()
 